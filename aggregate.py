@@ -0,0 +1,186 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import json
+
+from index import get_key
+from planner import compile_path
+from query import get_sort_key, MISSING
+
+# Aggregate functions, count without an attribute counts resources.
+FUNCTIONS = ("count", "min", "max", "sum", "avg")
+
+
+#
+# An Aggregate is one aggregate function of a select, e.g. avg(valueQuantity value).
+# Each group keeps a small state per aggregate, so memory is constant per group however many resources match:
+#   - count: [n]
+#   - sum, avg: [total, n]
+#   - min, max: [sort key, value]
+#
+class Aggregate:
+
+    def __init__(self, function, path=None):
+        self.function = function
+        self.path = path
+
+    def __str__(self):
+        if self.path is None:
+            return self.function
+        return self.function + "(" + " ".join(self.path) + ")"
+
+    # The state of a group with no values.
+    def start(self):
+        if self.function == "count":
+            return [0]
+        if self.function == "sum" or self.function == "avg":
+            return [0.0, 0]
+        return [None, None]
+
+    # Add a value to the state of a group, MISSING when the resource has no value.
+    def add(self, state, value):
+        if self.function == "count":
+            if self.path is None or (value is not MISSING and value is not None):
+                state[0] += 1
+        elif value is MISSING or value is None:
+            return
+        elif self.function == "sum" or self.function == "avg":
+            if isinstance(value, (bool, int, float)):
+                state[0] += value
+                state[1] += 1
+        else:
+            key = get_sort_key(value, False)
+            if state[0] is None or (key < state[0] if self.function == "min" else key > state[0]):
+                state[0] = key
+                state[1] = value
+
+    # Get the result of a group, None when there are no values.
+    def result(self, state):
+        if self.function == "count":
+            return state[0]
+        if self.function == "sum":
+            return state[0] if state[1] > 0 else None
+        if self.function == "avg":
+            return state[0] / state[1] if state[1] > 0 else None
+        return state[1]
+
+
+# Get the value of an index key, see index.get_key().
+def get_key_value(key):
+    if key.startswith("n:"):
+        return float(key[2:])
+    if key.startswith("s:"):
+        return key[2:]
+    return json.loads(key[2:])
+
+
+#
+# Get a function that returns the value of an attribute path of a resource, or MISSING.
+# A projected column or hash index on the path is used when there is one (and indexed is True),
+# so the resource is not parsed.
+#
+def get_value_function(collection, path, indexed=True):
+    projection = collection.get_index(path, "column") if indexed else None
+    if projection is not None:
+        def get_column_value(resource):
+            row = projection.rows.get(str(resource.uuid))
+            if row is None or not projection.present[row]:
+                return MISSING
+            if projection.numbers_mask[row]:
+                return float(projection.numbers[row])
+            if projection.strings_mask[row]:
+                return projection.strings[row]
+            return get_document_value(resource)
+
+    index = collection.get_index(path, "hash") if indexed else None
+    if index is not None:
+        def get_index_value(resource):
+            key = index.keys.get(str(resource.uuid))
+            return MISSING if key is None else get_key_value(key)
+
+    get_path = compile_path(path)
+
+    def get_document_value(resource):
+        try:
+            return get_path(resource.get_document())
+        except (KeyError, TypeError, IndexError):
+            return MISSING
+
+    if projection is not None:
+        return get_column_value
+    if index is not None:
+        return get_index_value
+    return get_document_value
+
+
+#
+# Aggregate the resources of a collection that match a plan (None for all resources) in one pass.
+# Resources are grouped by the value of an attribute path (None for one group of every resource).
+# Return a list of (group value, [aggregate results]) in group value order, MISSING for resources without a value.
+#
+def aggregate(collection, plan, aggregates, group_path=None):
+    counts = all(item.function == "count" and item.path is None for item in aggregates)
+
+    # Counts are answered from the plan or the group's hash index without reading the resources.
+    if counts and group_path is None:
+        count = len(collection.resources) if plan is None else plan.count(collection)
+        return [(MISSING, [count] * len(aggregates))]
+    if counts and plan is None:
+        snapshot, groups = collection.read(lambda snapshot: count_groups(snapshot, group_path, len(aggregates)))
+        if groups is not None:
+            return groups
+
+    # Values read from indexes and columns must agree with the resources that are aggregated,
+    # so the pass is made again from the resources if a write starts during it, see Collection.read().
+    snapshot = collection.snapshot
+    try:
+        groups = aggregate_resources(snapshot, plan, aggregates, group_path, True)
+        if snapshot.is_current():
+            return groups
+    except (RuntimeError, KeyError, IndexError):
+        # An index changed while it was read.
+        pass
+    return aggregate_resources(collection.snapshot, plan, aggregates, group_path, False)
+
+
+#
+# Count the resources of each group with the group's hash index.
+# Return None if the group attribute has no hash index.
+#
+def count_groups(snapshot, group_path, n):
+    group_index = snapshot.get_index(group_path, "hash")
+    if group_index is None:
+        return None
+    groups = [(get_key_value(key), [len(ids)] * n) for key, ids in group_index.values.items()]
+    missing = len(snapshot.resources) - len(group_index.keys)
+    if missing > 0:
+        groups.append((MISSING, [missing] * n))
+    groups.sort(key=lambda group: get_sort_key(group[0], False))
+    return groups
+
+
+# Aggregate the resources of a snapshot, indexed is True to read values from indexes and columns.
+def aggregate_resources(snapshot, plan, aggregates, group_path, indexed):
+    get_group = (lambda resource: MISSING) if group_path is None else \
+        get_value_function(snapshot, group_path, indexed)
+    get_values = [(lambda resource: MISSING) if item.path is None else
+                  get_value_function(snapshot, item.path, indexed) for item in aggregates]
+    resources = snapshot.resources if plan is None else plan.select(snapshot.collection)
+
+    groups = dict()
+    for resource in resources:
+        value = get_group(resource)
+        key = None if value is MISSING else get_key(value)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = (value, [item.start() for item in aggregates])
+        for item, get_value, state in zip(aggregates, get_values, group[1]):
+            item.add(state, get_value(resource))
+    if group_path is None and not groups:
+        groups[None] = (MISSING, [item.start() for item in aggregates])
+
+    results = [(value, [item.result(state) for item, state in zip(aggregates, states)])
+               for value, states in groups.values()]
+    results.sort(key=lambda group: get_sort_key(group[0], False))
+    return results
@@ -0,0 +1,125 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import json
+
+import planner
+from aggregate import aggregate, Aggregate, FUNCTIONS
+from query import MISSING
+
+
+#
+# Is a select an aggregate select, see aggregate_select().
+#
+def is_aggregate(query):
+    if "from" not in query or query.index("from") < 2:
+        return False
+    qualifier = query[1:query.index("from")]
+    return len(qualifier) > 1 or "(" in qualifier[0] or "," in qualifier[0] or get_group(query)[1] is not None
+
+
+#
+# Get the group by clause at the end of a select.
+# Return (query without the clause, attribute path), the path is None when there is no group by clause.
+#
+def get_group(query):
+    for i in range(len(query) - 2, 3, -1):
+        if query[i] == "group" and query[i + 1] == "by":
+            return query[:i], [token for token in query[i + 2:] if token != "with"]
+    return query, None
+
+
+#
+# Get the aggregates of a comma separated list, e.g. count, avg(valueQuantity value).
+# Return None if the list is not valid.
+#
+def get_aggregates(tokens):
+    aggregates = list()
+    for item in " ".join(tokens).split(","):
+        item = item.strip()
+        if item == "count":
+            aggregates.append(Aggregate("count"))
+            continue
+        function, _, rest = item.partition("(")
+        path = [token for token in rest[:-1].split(" ") if token != "" and token != "with"]
+        if function not in FUNCTIONS or not rest.endswith(")") or len(path) == 0:
+            print("Invalid aggregate:", item, "- use count or count|min|max|sum|avg(<attribute>)")
+            return None
+        aggregates.append(Aggregate(function, path))
+    return aggregates
+
+
+# Format an aggregate result or group value.
+def format_value(value):
+    if value is MISSING or value is None:
+        return "null"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+#
+# Aggregate select command.
+# select <aggregate>[, <aggregate> ...] from <collection_list> [where <condition>] [group by <attribute>]
+#     [limit <n>] [offset <m>]
+# <aggregate>:: count|count(<attribute>)|min(<attribute>)|max(<attribute>)|sum(<attribute>)|avg(<attribute>)
+# e.g. select count, avg(valueQuantity value) from Observation where status = final group by code coding code
+# Each collection is aggregated in one pass with a small state per group, see aggregate.py.
+# limit and offset page through the groups.
+# Return the (collection name, ms) taken by each collection, or None if the select did not run.
+#
+def aggregate_select(schema, query):
+    limits = planner.get_limit(query)
+    if limits is None:
+        return
+    query, limit, offset = limits
+    query, group_path = get_group(query)
+    if group_path is not None and len(group_path) == 0:
+        print("Invalid group by - attribute missing")
+        return
+
+    from_index = query.index("from")
+    aggregates = get_aggregates(query[1:from_index])
+    if aggregates is None:
+        return
+    if from_index + 1 >= len(query):
+        print("Invalid select clause - collection missing")
+        return
+
+    plan = None
+    where = query[from_index + 2:]
+    if len(where) > 0:
+        if where[0] != "where" or len(where) == 1:
+            print("Invalid where clause")
+            return
+        plan = planner.cache.get(where[1:])
+        if plan is None:
+            return
+
+    collections = list()
+    for collection_name in query[from_index + 1].split(","):
+        collection = schema.get_collection(collection_name)
+        if collection is None:
+            print("Invalid Collection")
+            return
+        collections.append(collection)
+
+    all_groups, timings = schema.map_collections(
+        lambda collection: aggregate(collection, plan, aggregates, group_path), collections)
+    stop = offset + schema.number_of_results
+    if limit is not None:
+        stop = offset + min(limit, schema.number_of_results)
+    for collection, groups in zip(collections, all_groups):
+        columns = [str(item) for item in aggregates]
+        if group_path is not None:
+            columns.insert(0, " ".join(group_path))
+        print(", ".join(columns))
+        for value, results in groups[offset:stop]:
+            row = [format_value(result) for result in results]
+            if group_path is not None:
+                row.insert(0, format_value(value))
+            print(", ".join(row))
+    return timings
@@ -0,0 +1,137 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import threading
+from collections import OrderedDict
+
+# A parsed document uses about 7 bytes of memory for each byte of json,
+# measured with tracemalloc on the sample Patient and Observation files.
+DOCUMENT_FACTOR = 7
+
+# Memory size units for --memory-limit.
+UNITS = {"KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+
+#
+# Parse a memory size such as 512MB, 2GB or 1000000.
+# Return the size in bytes or None if the size is invalid.
+#
+def parse_size(size):
+    size = size.strip().upper()
+    factor = 1
+    for unit, unit_factor in UNITS.items():
+        if size.endswith(unit):
+            size = size[:-len(unit)]
+            factor = unit_factor
+            break
+    try:
+        return int(float(size) * factor)
+    except ValueError:
+        return None
+
+
+#
+# A BufferPool keeps resource bodies (data and parsed document) in memory within a memory budget.
+# Resource ids and index data always stay in memory, bodies are read from storage on demand
+# and the least recently used bodies are evicted when the budget is exceeded.
+# A pool has:
+#   - The memory limit in bytes
+#   - The resident resources in least recently used order with their size
+#   - Pin counts of resources that cannot be evicted
+#   - Hit, miss and eviction counts
+# The pool is shared by the threads that select from several collections at once, see Schema.map_collections().
+#
+class BufferPool:
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.resources = OrderedDict()
+        self.pins = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "Buffer pool: " + str(self.used) + " of " + str(self.limit) + " bytes, " + \
+            str(len(self.resources)) + " resident, " + str(self.hits) + " hits, " + \
+            str(self.misses) + " misses, " + str(self.evictions) + " evictions"
+
+    # Record a use of a resident resource.
+    def hit(self, resource):
+        with self.lock:
+            if resource in self.resources:
+                self.hits += 1
+                self.resources.move_to_end(resource)
+
+    # Add a resident resource whose data can be read back from storage.
+    # miss is set when the data has just been read from storage.
+    def add(self, resource, size, miss=True):
+        with self.lock:
+            if miss:
+                self.misses += 1
+            self.set_size(resource, size)
+
+    # Add to the size of a resident resource, e.g. when its data is made from its record.
+    def grow(self, resource, size):
+        with self.lock:
+            if resource in self.resources:
+                self.set_size(resource, self.resources[resource] + size)
+
+    # Add the size of a resource's parsed document.
+    def add_document(self, resource):
+        with self.lock:
+            if resource in self.resources:
+                self.set_size(resource, self.resources[resource] * (1 + DOCUMENT_FACTOR))
+
+    # Set the size of a resident resource and evict other resources to stay within the limit.
+    # Called with the lock held.
+    def set_size(self, resource, size):
+        self.used += size - self.resources.pop(resource, 0)
+        self.resources[resource] = size
+        self.evict()
+
+    # Remove a resource from the pool, its data is no longer read from storage.
+    def remove(self, resource):
+        with self.lock:
+            size = self.resources.pop(resource, None)
+            if size is not None:
+                self.used -= size
+
+    #
+    # Evict least recently used resources until the pool is within its limit.
+    # A pinned resource is moved to the most recently used end instead.
+    # The most recently used resource is not evicted.
+    # Called with the lock held.
+    #
+    def evict(self):
+        pinned = 0
+        while self.used > self.limit and len(self.resources) - pinned > 1:
+            resource = next(iter(self.resources))
+            if resource in self.pins:
+                self.resources.move_to_end(resource)
+                pinned += 1
+                continue
+            self.used -= self.resources.pop(resource)
+            resource.unload()
+            self.evictions += 1
+
+    # Pin a resource so it is not evicted.
+    def pin(self, resource):
+        with self.lock:
+            self.pins[resource] = self.pins.get(resource, 0) + 1
+
+    # Unpin a resource.
+    def unpin(self, resource):
+        with self.lock:
+            count = self.pins.get(resource, 0) - 1
+            if count > 0:
+                self.pins[resource] = count
+            else:
+                self.pins.pop(resource, None)
+
+
+# The buffer pool, None when there is no memory limit.
+pool = None
@@ -4,12 +4,27 @@ Author: Tim Hastings, 2023
 """
 import os
 from datetime import datetime
+from itertools import islice
 
+import buffer_pool
+import planner
+import scatter
+
+from aggregate_cmd import aggregate_select, is_aggregate
 from order_cmd import order_collection
+from index_cmd import create_index, create_resource_index, project_collection, INDEX_COMMANDS, \
+    RESOURCE_INDEX_COMMANDS
+from search_cmd import search_collections
+from explain_cmd import explain_select
+from join import get_includes, get_revincludes
+from join_cmd import join_select
+from scatter_cmd import print_partitions, set_parallel
+from storage_cmd import compact_collection, compress_collection, migrate_collection
 from query import *
 from collection import Collection
-from resource import Resource
+from resource import Resource, compress_data
 from schema import Schema
+from storage import delete_resources, get_store, save_resources
 
 HELP = \
     "Commands (include spacing)\n" + \
@@ -18,12 +33,17 @@ HELP = \
     "info\n" + \
     "exit\n" + \
     "create <collection>\n" + \
+    "create index|rangeIndex <collection> on <attribute>\n" + \
+    "create index|rangeIndex <collection> on <segment> <attribute>\n" + \
+    "create index|rangeIndex <collection> on <segment1> with <segment2> <attribute>\n" + \
+    "create textIndex|referenceIndex <collection>\n" + \
     "results = n\n" + \
     "history\n" + \
     "clear\n" + \
     "reverse <collection>\n" + \
     "randomise <collection>\n" + \
-    "order|orderFast <collection> on <attribute>\n" +\
+    "project <collection> on <attribute>\n" + \
+    "order|orderFast <collection> on <attribute> [asc|desc][ , <attribute> [asc|desc]]\n" + \
     "select <qualifier> from <collection_list>\n" + \
     "select <qualifier> from <collection_list> where <attribute> <operator> <value>\n" + \
     "select <qualifier> from <collection_list> where <attribute> = <value> : <value>\n" + \
@@ -31,16 +51,30 @@ HELP = \
     "select <qualifier> from <collection_list> where <segment> <attribute> = <value> : <value>\n" + \
     "select <qualifier> from <collection_list> where <segment1> with <segment2> <attribute> <operator> <value>\n" + \
     "select <qualifier> from <collection_list> where <segment1> with <segment2> <attribute> = <value> : <value>\n" + \
+    "select <qualifier> from <collection_list> where <condition> and|or <condition> ...\n" + \
+    "select <qualifier> from <collection_list> [where <condition>] [limit <n>] [offset <m>]\n" + \
+    "select <qualifier> from <collection_list> [where <condition>] order by <attribute> [asc|desc][ , ...] [limit <n>]\n" + \
     "selectDistinct <qualifier> from <collection_list> where <attribute> <operator> <value>\n" + \
-    "<qualifier>:: *|id|data|count\n" \
+    "select <aggregate>[, <aggregate> ...] from <collection_list> [where <condition>] [group by <attribute>]\n" + \
+    "select <qualifier> from <collection> join <collection> on <attribute> = <attribute> [where <condition>]\n" + \
+    "parallel <n>|off\n" + \
+    "explain select|selectDistinct <qualifier> from <collection_list> where <condition>\n" + \
+    "search <qualifier> from <collection_list> for <text> [<text> ...]\n" + \
+    "<qualifier>:: *|id|data|count\n" + \
+    "<aggregate>:: count|count(<attribute>)|min(<attribute>)|max(<attribute>)|sum(<attribute>)|avg(<attribute>)\n" \
     "<collection_list>:: <collection>[,<collection>]\n " \
     "<operator>:: =|!=|>|>=|<|<=\n" + \
-    "get <id> from <collection>\n" + \
+    "<condition>:: <segment> ... <attribute> <operator> <value> | ( <condition> and|or <condition> ... )\n" + \
+    "get <id> from <collection> [include <collection_list>] [revinclude <collection_list>]\n" + \
     "insert json <json> into <collection> \n" + \
     "insert file <filename> into <collection>\n" + \
     "update <collection> json <json> where id = <id>\n" + \
     "update <collection> file <filename> where id = <id>\n" + \
+    "remove <collection> where id = <id>\n" + \
     "copy <collection> to <collection>\n" + \
+    "migrate <collection>\n" + \
+    "compact <collection>\n" + \
+    "compress <collection> [<level>|off]\n" + \
     "load n <filename> into <collection>"
 
 COMMAND_INDEX = 0
@@ -90,10 +124,14 @@ def cli(schema):
                 display_info(schema)
             elif command == "exit":
                 exit(0)
+            elif command == "create" and len(command_line) > 1 and command_line[1] in INDEX_COMMANDS:
+                create_index(schema, command_line)
+            elif command == "create" and len(command_line) > 1 and command_line[1] in RESOURCE_INDEX_COMMANDS:
+                create_resource_index(schema, command_line)
             elif command == "create":
                 create_collection(schema, command_line)
             elif command == "remove":
-                print("TBA")
+                remove_resource(schema, command_line)
             elif command == "results":
                 set_number_of_results(schema, command_line)
             elif command == "history":
@@ -123,11 +161,32 @@ def cli(schema):
             #   Place functions in new file
             #   Add import at the top of this file.
             #
-            elif command == "order" or "orderFast":
+            elif command == "search":
+                searched = search_collections(schema, command_line)
+                if searched is not None:
+                    results, timings = searched
+                    print_select(schema, command_line, results)
+                    print_timings(timings)
+            elif command == "parallel":
+                set_parallel(schema, command_line)
+            elif command == "explain":
+                explain_select(schema, command_line)
+            elif command == "project":
+                project_collection(schema, command_line)
+            elif command == "migrate":
+                migrate_collection(schema, command_line)
+            elif command == "compact":
+                compact_collection(schema, command_line)
+            elif command == "compress":
+                compress_collection(schema, command_line)
+            elif command == "order" or command == "orderFast":
                 order_collection(schema, command_line)
             else:
                 print("Unknown command")
 
+            # Persist any index changes made by the command.
+            schema.save_indexes()
+
             # Find the start to end time difference and display.
             end = datetime.now()
             td = (end - start).total_seconds() * 10 ** 3
@@ -174,23 +233,30 @@ def print_select(schema, query, results):
         command += token + " "
 
     qualifier = query[QUALIFIER_INDEX]
+    printed = list()
     for resource in results:
+        if buffer_pool.pool is not None:
+            # Keep the resource in memory while it is printed.
+            buffer_pool.pool.pin(resource)
         if qualifier == "*":
             print(resource)
-            temp_results.resources.append(resource)
+            printed.append(resource)
         elif qualifier == "id":
             print(resource.uuid)
-            temp_results.resources.append(resource.uuid)
+            printed.append(resource.uuid)
         elif qualifier == "data":
             print(resource.data)
-            temp_results.resources.append(resource.uuid)
+            printed.append(resource.uuid)
         else:
             print("print_select(): Invalid select qualifier")
             return
+        if buffer_pool.pool is not None:
+            buffer_pool.pool.unpin(resource)
 
         n += 1
         if n >= schema.number_of_results:
             break
+    temp_results.add_results(printed)
 
 
 def is_qualifier(qualifier):
@@ -199,35 +265,6 @@ def is_qualifier(qualifier):
     return False
 
 
-# =|!=|>|>=|<|<=
-def is_operator(operator):
-    if operator == "=" or operator == "!=" or operator == ">" or \
-            operator == ">=" or operator == "<" or operator == "<=":
-        return True
-    return False
-
-
-def is_range_operator(rng):
-    if rng != ":":
-        print("Invalid range operator", rng)
-        return False
-    return True
-
-
-def is_valid_range(low, high):
-    try:
-        lo = float(low)
-        hi = float(high)
-        if lo <= hi:
-            return True
-        else:
-            print("Invalid Range - low value must be less than or equal to high value")
-        return False
-    except (TypeError, ValueError):
-        print("Invalid Range - not a number")
-        return False
-
-
 def is_valid_select(query):
     if len(query) < 4:
         print("Invalid select clause - too few arguments")
@@ -255,153 +292,107 @@ def is_validate_where(query):
 
 #
 # Process a select query.
+# The where clause is compiled to a plan once and the plan is cached, see planner.py.
+# Results are generated as they are printed, so a scan stops once the limit,
+# the offset plus the number of results to display, have been found.
+# A count is made without building a result list.
+# order by returns the first results in order without reordering the collection.
+# Aggregates such as count, avg(<attribute>) and group by are run by aggregate_cmd.py.
 #
 def select(schema, query, distinct):
+    if is_aggregate(query):
+        timings = aggregate_select(schema, query)
+        if timings is not None:
+            print_timings(timings)
+        return
     if not is_valid_select(query):
         return
 
-    # Build a comma separated collection list.
-    collections = list()
-    if query[COMMAND_INDEX].find(','):
-        collections = query[COLLECTION_INDEX].split(',')
-    else:
-        collections.append(query[COLLECTION_INDEX])
-
-    if len(query) == 4:
-        # select <qualifier> from <collection_list>
-        for collection_name in collections:
-            collection = schema.get_collection(collection_name)
-
-            if not is_valid_collection(collection):
-                return
+    limits = planner.get_limit(query)
+    if limits is None:
+        return
+    query, limit, offset = limits
+    if distinct:
+        limit = 1 if limit is None else min(limit, 1)
+    if len(query) > 4 and query[4] == "join":
+        join_select(schema, query, limit, offset)
+        return
 
-            if query[QUALIFIER_INDEX] == "count":
-                print(len(collection.resources))
-            else:
-                print_select(schema, query, collection.resources)
+    orders = planner.get_order(query)
+    if orders is None:
+        return
+    query, keys = orders
 
-    elif len(query) == 5:
+    plan = None
+    if len(query) == 5:
         print("Invalid command")
         return
-    elif len(query) == 8:
-        # select <qualifier> from <collection_list> where <attribute> = <value>
-        for collection_name in collections:
-            collection = schema.get_collection(collection_name)
-            if not is_valid_collection(collection):
-                return
-            if not is_validate_where(query):
-                return
-            attribute = query[5]
-            operator = query[6]
-            if not is_operator(operator):
-                return
-            value = query[7]
-            results = get_resources_by_attribute_value(collection, attribute, operator, value, distinct)
-            print_select(schema, query, results)
+    elif len(query) > 5:
+        if not is_validate_where(query):
+            return
+        plan = planner.cache.get(query[WHERE_INDEX + 1:])
+        if plan is None:
+            return
 
-    elif len(query) == 9:
-        # get <qualifier> from <collection_list> where <segment> <attribute> = <value>
-        for collection_name in collections:
-            collection = schema.get_collection(collection_name)
-            if not is_valid_collection(collection):
-                return
-            if not is_validate_where(query):
-                return
-            segment = query[5]
-            attribute = query[6]
-            operator = query[7]
-            if not is_operator(operator):
-                return
-            value = query[8]
-            results = get_resources_by_segment_attribute_value(collection, segment, attribute, operator, value)
-            print_select(schema, query, results)
-    elif len(query) == 10:
-        # get <qualifier> from <collection_list> where <attribute> = <low> : <high>
-        for collection_name in collections:
-            collection = schema.get_collection(collection_name)
-            if not is_valid_collection(collection):
-                return
-            if not is_validate_where(query):
-                return
-            attribute = query[5]
-            low = query[7]
-            rng = query[8]
-            if not is_range_operator(rng):
-                return
-            high = query[9]
-            if not is_valid_range(low, high):
-                return
-            results = get_resources_by_attribute_range(collection, attribute, float(low), float(high), False)
-            print_select(schema, query, results)
-    elif len(query) == 11 and query[6] != "with":
-        # get <qualifier> from <collection_list> where <segment> <attribute> = <low> : <high>
-        for collection_name in collections:
-            collection = schema.get_collection(collection_name)
-            if not is_valid_collection(collection):
-                return
-            if not is_validate_where(query):
-                return
-            segment = query[5]
-            attribute = query[6]
-            low = query[8]
-            rng = query[9]
-            if not is_range_operator(rng):
-                return
-            high = query[10]
-            if not is_valid_range(low, high):
-                return
-            results = get_resources_by_segment_attribute_range(collection, segment, attribute, float(low),
-                                                               float(high))
-            print_select(schema, query, results)
-    elif len(query) == 11 and query[6] == "with":
-        # select <qualifier> from <collection_list> where <segment1> <segment2> with <attribute> <operator> <value>
-        for collection_name in collections:
-            collection = schema.get_collection(collection_name)
-            if not is_valid_collection(collection):
-                return
-            if not is_validate_where(query):
-                return
-            segment1 = query[5]
-            segment2 = query[7]
-            attribute = query[8]
-            operator = query[9]
-            if not is_operator(operator):
-                return
-            value = query[10]
-            results = get_resources_by_2segments_attribute_value(collection, segment1, segment2, attribute, operator,
-                                                                 value)
-            print_select(schema, query, results)
-    elif len(query) == 13 and query[6] == "with":
-        # select <qualifier> from <collection_list> where <segment1> with <segment2> <attribute> <operator> low : high
-        for collection_name in collections:
-            collection = schema.get_collection(collection_name)
-            if not is_valid_collection(collection):
-                return
-            if not is_validate_where(query):
-                return
-            segment1 = query[5]
-            segment2 = query[7]
-            attribute = query[8]
-            low = query[10]
-            rng = query[11]
-            if not is_range_operator(rng):
-                return
-            high = query[12]
-            results = get_resources_by_2segments_attribute_range(collection, segment1, segment2, attribute,
-                                                                 float(low), float(high))
+    # The comma separated collection list.
+    collections = list()
+    for collection_name in query[COLLECTION_INDEX].split(','):
+        collection = schema.get_collection(collection_name)
+        if not is_valid_collection(collection):
+            return
+        collections.append(collection)
+
+    # Stop at the first of the limit and the number of results displayed.
+    stop = offset + schema.number_of_results
+    if limit is not None:
+        stop = offset + min(limit, schema.number_of_results)
+
+    # Select from each collection, the collections are evaluated concurrently.
+    def select_collection(collection):
+        if query[QUALIFIER_INDEX] == "count":
+            count = len(collection.resources) if plan is None else plan.count(collection)
+            count = max(0, count - offset)
+            return count if limit is None else min(count, limit)
+        if keys is not None:
+            results = iter(planner.order_by(collection, plan, keys, stop))
+        elif plan is None:
+            results = iter(collection.resources)
+        else:
+            results = plan.select(collection, stop)
+        if len(collections) > 1:
+            return list(islice(results, offset, stop))
+        # A single collection is evaluated as its results are printed.
+        return islice(results, offset, stop)
+
+    all_results, timings = schema.map_collections(select_collection, collections)
+    for collection, results in zip(collections, all_results):
+        if query[QUALIFIER_INDEX] == "count":
+            print(results)
+        else:
             print_select(schema, query, results)
-    else:
-        print("Invalid command - check number of parameters")
+        print_partitions(collection.name)
+    print_timings(timings)
+
+
+#
+# Print the time taken by each collection of a multi-collection query.
+#
+def print_timings(timings):
+    if len(timings) > 1:
+        for name, ms in timings:
+            print(f"{name}: {ms:.02f} ms")
 
 #
 #   Process a get command.
+#   get <id> from <collection> [include <collection_list>] [revinclude <collection_list>]
+#   include adds the resources that the resource refers to, revinclude adds the resources that refer to it.
 #
 def get_resource_by_id(schema, query):
     temp_results = schema.get_collection("Result")
     if temp_results is None:
         print("Invalid Collection")
         return
-    if len(query) != 4:
+    if len(query) < 4 or len(query) % 2 != 0:
         print("Missing number of arguments")
         return
     collection = schema.get_collection(query[3])
@@ -409,11 +400,32 @@ def get_resource_by_id(schema, query):
         print("Invalid collection")
         return
 
+    clauses = list()
+    for i in range(4, len(query), 2):
+        if query[i] not in ("include", "revinclude"):
+            print("Invalid get command: use include or revinclude")
+            return
+        collections = list()
+        for name in query[i + 1].split(","):
+            related = schema.get_collection(name)
+            if related is None:
+                print("Invalid collection:", name)
+                return
+            collections.append(related)
+        clauses.append((query[i], collections))
+
     id = query[1]
     result = collection.get(id)
-    temp_results.resources.append(result)
+    printed = [result]
     print(result)
-    return
+    if result is not False:
+        for clause, collections in clauses:
+            get_related = get_includes if clause == "include" else get_revincludes
+            for related in collections:
+                for resource in get_related(result, related):
+                    printed.append(resource)
+                    print("    " + clause + " " + related.name + ": " + str(resource))
+    temp_results.add_results(printed)
 
 
 def is_valid_insert_command(schema, command_line):
@@ -449,15 +461,15 @@ def insert_resource(schema, command_line):
     if command_line[1] == "json":
         resource.type = collection_name
         resource.data = command_line[2]
-        collection.add_resource(resource)
         resource.save()
+        collection.add_resource(resource)
         print(resource.uuid)
     elif command_line[1] == "file" or len(command_line[1]) > 0:
         if not resource.load_file(command_line[2], ""):
             print("File not Found")
             return None
-        collection.add_resource(resource)
         resource.save()
+        collection.add_resource(resource)
         print(resource.uuid)
     else:
         print("Invalid insert command")
@@ -466,13 +478,34 @@ def insert_resource(schema, command_line):
 
 #
 #   Bulk Load a file into a collection
+#   The file is read once and the resources are written in batches.
 #
 def load(schema, command_line):
     if not is_valid_insert_command(schema, command_line):
         return
-    n = int(command_line[1])
+    try:
+        n = int(command_line[1])
+    except ValueError:
+        print("Invalid load command: n must be a number")
+        return
+
+    collection_name = command_line[4]
+    collection = schema.get_collection(collection_name)
+    source = Resource(collection_name)
+    if not source.load_file(command_line[2], ""):
+        print("File not Found")
+        return
+    source.data = compress_data(source.data)
+
+    resources = list()
     for i in range(0, n):
-        insert_resource(schema, command_line)
+        resource = Resource(collection_name)
+        resource.copy_data(source)
+        resources.append(resource)
+
+    save_resources(collection_name, resources)
+    collection.add_resources(resources)
+    print(n, "resources loaded into", collection_name)
 
 
 #
@@ -521,13 +554,42 @@ def update_resource(schema, command_line):
         print("Invalid Collection")
         return
 
-    for resource in collection.resources:
-        if str(resource.uuid) == str(id):
-            resource.data = data
-            resource.save()
-            return
-    print("Update command: Resource not found")
-    return
+    resource = collection.get(id)
+    if not resource:
+        print("Update command: Resource not found")
+        return
+    resource = resource.new_version(data)
+    resource.save()
+    collection.update_resource(id, resource)
+
+
+#
+# Process a remove command.
+# remove <collection> where id = <id>
+# The resource is deleted from storage, then from the collection and its indexes.
+#
+def remove_resource(schema, command_line):
+    if len(command_line) != 6:
+        print("Invalid remove command: too few arguments")
+        return
+    if command_line[2] != "where" or command_line[3] != "id" or command_line[4] != "=":
+        print("Invalid remove command: use where id = <id>")
+        return
+    collection = schema.get_collection(command_line[1])
+    if collection is None:
+        print("Invalid Collection")
+        return
+
+    id = command_line[5]
+    if not collection.get(id):
+        print("Remove command: Resource not found")
+        return
+    try:
+        delete_resources(collection.name, [id])
+    except OSError:
+        print("Resource: Delete Error")
+        return
+    collection.del_resource(id)
 
 
 def is_valid_copy_command(schema, command_line):
@@ -555,7 +617,7 @@ def copy_collection(schema, command_line):
     to_name = command_line[3]
 
     if not collection_exists(schema, to_name):
-        create_collection(schema, to_name)
+        create_collection(schema, ["create", to_name])
 
     from_collection = schema.get_collection(from_name)
     to_collection = schema.get_collection(to_name)
@@ -564,14 +626,17 @@ def copy_collection(schema, command_line):
         print("Invalid Collection")
         return
 
+    resources = list()
     for resource in from_collection.resources:
         r = Resource(from_name)
         r.uuid = resource.uuid
         r.type = to_name
         r.data = resource.data
         r.state = resource.state
-        to_collection.resources.append(r)
-    to_collection.save()
+        resources.append(r)
+    # Write the copies in batches and add them with one write, not one save per resource.
+    save_resources(to_name, resources)
+    to_collection.add_resources(resources)
 
 #
 # Reverse a collection's order.
@@ -606,8 +671,25 @@ def display_help():
 
 def display_info(schema):
     print(schema.name + ", " + schema.version + " by " + schema.author)
+    if buffer_pool.pool is not None:
+        print(buffer_pool.pool)
+    print(planner.cache)
+    if scatter.pool is not None:
+        print(scatter.pool)
     for collection in schema.collections:
-        print(collection.name + ": " + str(len(collection.resources)) + " entries")
+        if collection.bodies:
+            print(collection.name + ": " + str(len(collection.resources)) + " entries, " +
+                  str(len(collection.bodies)) + " bodies")
+        else:
+            print(collection.name + ": " + str(len(collection.resources)) + " entries")
+        store = get_store(collection.name)
+        if store is not None:
+            print("    " + str(store))
+            rate = store.get_decode_rate()
+            if rate is not None:
+                print("    decompress " + str(round(rate, 1)) + " MB/s")
+        for index in collection.indexes:
+            print("    " + str(index))
 
 
 # Create a new collection
@@ -2,103 +2,592 @@
 FHIR Server Proof of Concept
 Author: Tim Hastings, 2023
 """
+import heapq
+import os
 import random
+import threading
 import uuid
+from itertools import chain
+
+import buffer_pool
 from schema import Schema
-from resource import Resource
-from query import get_attribute_value
+from resource import Resource, compress_data, read_file
+from index import AttributeIndex, TextIndex, load_indexes, save_indexes
+from query import get_path_value, get_sort_key
+from storage import get_store
+
+# Collections with at least this many resources use the compressors process pool when loading.
+PARALLEL_LOAD = 1000
+# Number of resources sent to a process pool worker at a time.
+LOAD_CHUNK = 250
+# Number of times a read of the indexes is tried before it waits for writers, see Collection.read().
+READ_RETRIES = 3
+# Number of slots in each chunk of a ResourceList.
+CHUNK_SIZE = 1024
+# Average number of ids in each shard of an IdMap, a map with twice as many is split into more shards.
+SHARD_SIZE = 512
+
+
+#
+# A ResourceList is the list of resources of a snapshot, kept in fixed-size chunks.
+# A write makes a new list that shares every chunk it does not change with the list it was made
+# from, so it copies the list of chunks and one chunk, not every resource.
+# Each resource has a slot, its position in the chunks. A deleted resource leaves an empty slot (None),
+# so the slots of other resources do not change. The list is compacted when half the slots are empty,
+# see Collection.del_resource().
+# A ResourceList is never changed once it is published in a snapshot.
+#
+class ResourceList:
+
+    def __init__(self, chunks=None, size=0):
+        self.chunks = chunks if chunks is not None else list()
+        self.size = size
+
+    # Make a ResourceList from a list of resources.
+    @classmethod
+    def from_list(cls, resources):
+        return cls([resources[i:i + CHUNK_SIZE] for i in range(0, len(resources), CHUNK_SIZE)], len(resources))
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        resources = chain.from_iterable(self.chunks)
+        if self.size == self.count_slots():
+            return resources
+        return (resource for resource in resources if resource is not None)
+
+    # Get the resource in a slot, None if the slot is empty.
+    def __getitem__(self, slot):
+        return self.chunks[slot // CHUNK_SIZE][slot % CHUNK_SIZE]
+
+    # Get the resources in a list of slots.
+    def get_many(self, slots):
+        chunks = self.chunks
+        return [chunks[slot // CHUNK_SIZE][slot % CHUNK_SIZE] for slot in slots]
+
+    # Get the number of slots, including the empty slots.
+    def count_slots(self):
+        return (len(self.chunks) - 1) * CHUNK_SIZE + len(self.chunks[-1]) if self.chunks else 0
+
+    # Generate the (slot, resource) of each resource.
+    def get_slots(self):
+        return ((slot, resource) for slot, resource in enumerate(chain.from_iterable(self.chunks))
+                if resource is not None)
+
+    # Get a new list with a list of resources added at the end.
+    def extend(self, resources):
+        chunks = list(self.chunks)
+        chunk = list(chunks.pop()) if chunks and len(chunks[-1]) < CHUNK_SIZE else list()
+        for resource in resources:
+            if len(chunk) == CHUNK_SIZE:
+                chunks.append(chunk)
+                chunk = list()
+            chunk.append(resource)
+        if chunk:
+            chunks.append(chunk)
+        return ResourceList(chunks, self.size + len(resources))
+
+    # Get a new list with the resource in a slot replaced, None to empty the slot.
+    def replace(self, slot, resource):
+        chunks = list(self.chunks)
+        chunk = chunks[slot // CHUNK_SIZE] = list(chunks[slot // CHUNK_SIZE])
+        old = chunk[slot % CHUNK_SIZE]
+        chunk[slot % CHUNK_SIZE] = resource
+        return ResourceList(chunks, self.size + (resource is not None) - (old is not None))
+
+
+#
+# An IdMap is a map of resource id to a value (a resource or a slot) for a snapshot, with the
+# read interface of a dictionary. The ids are split by hash into shards, so a write makes a new map
+# that shares every shard it does not change with the map it was made from.
+# An IdMap is never changed once it is published in a snapshot.
+#
+class IdMap:
+
+    def __init__(self, shards=None, size=0):
+        self.shards = shards if shards is not None else [dict()]
+        self.mask = len(self.shards) - 1
+        self.size = size
+
+    # Make an IdMap from (id, value) items, with enough shards for SHARD_SIZE ids each.
+    @classmethod
+    def from_items(cls, items):
+        items = list(items)
+        count = 1
+        while count * SHARD_SIZE < len(items):
+            count *= 2
+        shards = [dict() for i in range(count)]
+        for id, value in items:
+            shards[hash(id) & (count - 1)][id] = value
+        return cls(shards, sum(map(len, shards)))
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return chain.from_iterable(self.shards)
+
+    def __contains__(self, id):
+        return id in self.shards[hash(id) & self.mask]
+
+    def __getitem__(self, id):
+        return self.shards[hash(id) & self.mask][id]
+
+    def get(self, id, default=None):
+        return self.shards[hash(id) & self.mask].get(id, default)
+
+    # Get the values of a list of ids.
+    def get_many(self, ids):
+        shards = self.shards
+        mask = self.mask
+        return [shards[hash(id) & mask][id] for id in ids]
+
+    def items(self):
+        return chain.from_iterable(shard.items() for shard in self.shards)
+
+    #
+    # Get a new map with (id, value) items set and a list of ids removed.
+    # Each changed shard is copied once. A map that has grown past SHARD_SIZE ids a shard is split again.
+    #
+    def update(self, items=(), removed=()):
+        shards = list(self.shards)
+        copied = set()
+        size = self.size
+        for id in removed:
+            number = hash(id) & self.mask
+            if number not in copied:
+                shards[number] = dict(shards[number])
+                copied.add(number)
+            if shards[number].pop(id, None) is not None:
+                size -= 1
+        for id, value in items:
+            number = hash(id) & self.mask
+            if number not in copied:
+                shards[number] = dict(shards[number])
+                copied.add(number)
+            size += id not in shards[number]
+            shards[number][id] = value
+        if size > 2 * SHARD_SIZE * len(shards):
+            return IdMap.from_items(chain.from_iterable(shard.items() for shard in shards))
+        return IdMap(shards, size)
+
+
+#
+# A Snapshot is a consistent version of the resources of a collection.
+# Writers never change a snapshot, they make a new resource list and id map that share the unchanged
+# chunks and shards of the old ones (see ResourceList and IdMap) and publish them as a new snapshot.
+# A write of one resource costs O(n / CHUNK_SIZE), not O(n). A reader that holds a snapshot sees the
+# resources as they were when it was published, however long the read takes, and readers never wait for writers.
+# An update replaces a resource with a new resource, so the resources of a snapshot do not change either.
+# A snapshot has the read interface of a collection:
+#   - The collection, its name and the version of the collection it was published at
+#   - A ResourceList of resources
+#   - An IdMap of resources keyed by id
+#   - The slot of each resource id in the ResourceList, an IdMap made when first needed
+#   - The list of indexes, which writers change in place, see Collection.read()
+#
+class Snapshot:
+
+    def __init__(self, collection, resources, ids, version, positions=None):
+        self.collection = collection
+        self.name = collection.name
+        self.resources = resources
+        self.ids = ids
+        self.version = version
+        self.positions = positions
+        self.indexes = list(collection.indexes)
+
+    # Is this the latest snapshot with no write started since it was published.
+    def is_current(self):
+        return self.collection.version == self.version
+
+    #
+    # Get the index on an attribute path.
+    # Return None if the path is not indexed.
+    #
+    def get_index(self, path, kind="hash"):
+        for index in self.indexes:
+            if index.KIND == kind and index.path == path:
+                return index
+        return None
+
+    #
+    # Get the position (slot) of each resource id in the collection.
+    #
+    def get_positions(self):
+        positions = self.positions
+        if positions is None:
+            positions = IdMap.from_items((str(resource.uuid), slot) for slot, resource in self.resources.get_slots())
+            self.positions = positions
+        return positions
+
+    #
+    # Return the resources for a set of ids in collection order.
+    # With a limit only the first limit resources are returned, found without sorting every id.
+    #
+    def in_order(self, ids, limit=None):
+        slots = self.get_positions().get_many(ids)
+        if limit is not None and limit < len(ids):
+            return self.resources.get_many(heapq.nsmallest(limit, slots))
+        slots.sort()
+        return self.resources.get_many(slots)
+
+    #
+    # Get a resource using its id and return the resource.
+    #
+    def get(self, id):
+        return self.ids.get(str(id), False)
+
 
 #
 # The Collection class is analogous to a table.
 # A collection has:
 #   - A unique identifier
 #   - A name used to store data
-#   - A list of resources
+#   - A snapshot of the list of resources and the dictionary of resources keyed by id
+#   - A list of attribute indexes
+#   - A write lock and a version, changed by every write
+#   - The bodies of its resources, so identical resources share their data, see share()
 #   - The state of a collection - LOADED | SAVED
+# Writers hold the lock, so writes to a collection happen one at a time, and publish a new snapshot.
 #
 class Collection:
 
     def __init__(self, name):
         self.uuid = str(uuid.uuid4())
         self.name = name
-        self.resources = list()
+        self.indexes = list()
+        self.indexes_changed = False
+        self.lock = threading.RLock()
+        self.version = 0
+        self.snapshot = Snapshot(self, ResourceList(), IdMap(), self.version)
+        self.bodies = dict()
         self.state = Schema.LOADED
 
     def __str__(self):
         return self.uuid + ", " + self.name + ", " + self.state
 
+    # The resources of the latest snapshot.
+    @property
+    def resources(self):
+        return self.snapshot.resources
+
+    # The resources of the latest snapshot keyed by id.
+    @property
+    def ids(self):
+        return self.snapshot.ids
+
+    # Start a write, the lock must be held. Reads of the indexes that overlap the write are retried.
+    def start_write(self):
+        self.version += 1
+
+    # Publish the resources of a write as the new snapshot, the lock must be held.
+    def publish(self, resources, ids, positions=None):
+        self.version += 1
+        self.snapshot = Snapshot(self, resources, ids, self.version, positions)
+
+    #
+    # Run a read of the indexes, function(snapshot), and return (snapshot, result).
+    # Writers change the indexes in place, so the read is tried again if a write starts before it
+    # returns, and the result always agrees with the snapshot. After READ_RETRIES tries the read
+    # holds the lock, so that it is not held up indefinitely by a stream of writes.
+    #
+    def read(self, function):
+        for i in range(READ_RETRIES):
+            snapshot = self.snapshot
+            try:
+                result = function(snapshot)
+                if snapshot.is_current():
+                    return snapshot, result
+            except (RuntimeError, KeyError, IndexError):
+                # An index changed while it was read.
+                pass
+        with self.lock:
+            snapshot = self.snapshot
+            return snapshot, function(snapshot)
+
+    #
+    # Share the data of resources with identical bodies, so each distinct body is kept in memory once.
+    # bodies holds the first resource with each body and the number of resources with the body.
+    # Resources whose data is not kept in memory are not shared. The lock must be held.
+    #
+    def share(self, resources):
+        for resource in resources:
+            body = resource.get_body()
+            if body is None:
+                continue
+            entry = self.bodies.get(body)
+            if entry is None:
+                self.bodies[body] = [resource, 1]
+                continue
+            if entry[0].get_body() != body:
+                # The data of the shared resource has changed.
+                entry[0] = resource
+            elif entry[0] is not resource:
+                resource.share(entry[0])
+            entry[1] += 1
+
+    # Release the bodies of resources that have left the collection, the lock must be held.
+    def release(self, resources):
+        for resource in resources:
+            body = resource.get_body()
+            entry = self.bodies.get(body) if body is not None else None
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.bodies[body]
+
     # Add a resource to the collection.
     def add_resource(self, resource):
-        self.resources.append(resource)
+        self.add_resources([resource])
 
-    # Delete a resource form the collection.
+    # Add a list of resources to the collection in one step.
+    def add_resources(self, resources):
+        with self.lock:
+            self.start_write()
+            snapshot = self.snapshot
+            positions = snapshot.positions
+            if positions is not None:
+                slots = enumerate(resources, snapshot.resources.count_slots())
+                positions = positions.update([(str(resource.uuid), slot) for slot, resource in slots])
+            ids = snapshot.ids.update([(str(resource.uuid), resource) for resource in resources])
+            for index in self.indexes:
+                for resource in resources:
+                    index.add(resource)
+            if self.indexes:
+                self.indexes_changed = True
+            self.share(resources)
+            self.publish(snapshot.resources.extend(resources), ids, positions)
+
+    #
+    # Add a list of results (resources, ids or False for not found) to the end of the Result collection in one step.
+    # Results are only displayed, they are not indexed or found by id.
+    #
+    def add_results(self, results):
+        with self.lock:
+            self.start_write()
+            self.publish(self.resources.extend(results), self.ids)
+
+    #
+    # Delete a resource form the collection, its slot is left empty.
+    # When half the slots are empty the resource list is compacted, so the slots are numbered again.
+    #
     def del_resource(self, id):
-        for resource in self.resources:
-            if resource.uuid == id:
-                self.resources.remove(resource)
-                break
+        with self.lock:
+            id = str(id)
+            resource = self.ids.get(id)
+            if resource is not None:
+                snapshot = self.snapshot
+                positions = snapshot.get_positions()
+                self.start_write()
+                for index in self.indexes:
+                    index.remove(id)
+                self.indexes_changed = True
+                self.release([resource])
+                resources = snapshot.resources.replace(positions[id], None)
+                positions = positions.update(removed=[id])
+                if 2 * len(resources) < resources.count_slots():
+                    resources = ResourceList.from_list(list(resources))
+                    positions = None
+                self.publish(resources, snapshot.ids.update(removed=[id]), positions)
 
-    # Update a resource.
+    # Update a resource, it is replaced by a new resource in the same slot.
     def update_resource(self, id, res):
-        for resource in self.resources:
-            if resource.uuid == id:
-                self.resources = res
-                break
+        with self.lock:
+            id = str(id)
+            resource = self.ids.get(id)
+            if resource is not None:
+                snapshot = self.snapshot
+                positions = snapshot.get_positions()
+                slot = positions[id]
+                self.start_write()
+                for index in self.indexes:
+                    index.remove(id)
+                for index in self.indexes:
+                    index.add(res)
+                if self.indexes:
+                    self.indexes_changed = True
+                self.release([resource])
+                self.share([res])
+                ids = snapshot.ids.update([(str(res.uuid), res)], [id] if str(res.uuid) != id else ())
+                if str(res.uuid) != id:
+                    positions = positions.update([(str(res.uuid), slot)], [id])
+                self.publish(snapshot.resources.replace(slot, res), ids, positions)
+
+    #
+    # Get the index on an attribute path.
+    # Return None if the path is not indexed.
+    #
+    def get_index(self, path, kind="hash"):
+        for index in self.indexes:
+            if index.KIND == kind and index.path == path:
+                return index
+        return None
+
+    #
+    # Create an index on an attribute path.
+    #
+    def create_index(self, path, index_type=AttributeIndex):
+        with self.lock:
+            self.start_write()
+            index = self.get_index(path, index_type.KIND)
+            if index is None:
+                index = index_type(path)
+                self.indexes.append(index)
+            index.build(self.resources)
+            self.indexes_changed = True
+            self.publish(self.resources, self.ids, self.snapshot.positions)
+            return index
+
+    #
+    # Save the indexes if they have changed.
+    #
+    def save_indexes(self):
+        with self.lock:
+            if self.indexes_changed:
+                save_indexes(self)
+                self.indexes_changed = False
+
+    #
+    # Get the position of each resource id in the collection.
+    #
+    def get_positions(self):
+        return self.snapshot.get_positions()
+
+    #
+    # Return the resources for a set of ids in collection order, see Snapshot.in_order().
+    #
+    def in_order(self, ids, limit=None):
+        return self.snapshot.in_order(ids, limit)
 
     #
     # Get a resource using its id and return the resource.
     #
     def get(self, id):
-        for resource in self.resources:
-            if str(resource.uuid) == str(id):
-                return resource
-        return False
+        return self.ids.get(str(id), False)
 
     #
     # Search a collection using query()
     # Return a result list of resources.
     #
     def search(self, qry):
-        result = list()
-        i = 0
-        for resource in self.resources:
-            if resource.search(qry):
-                result.append(resource)
-        return result
+        return self.search_complex([qry])
 
     #
     # Search a collection using using a query set.
     # Each query in the set must be a match.
     # You need to consider the structure of the collection to form the query.
     # '{', '}', '[' and ']' may be left out.
+    # A text index narrows the resources to check, see index.TextIndex.
     #
     def search_complex(self, query_set):
-        results = list()
-        for qry in query_set:
-            results += self.search(qry)
-        return results
+        def find(snapshot):
+            index = snapshot.get_index([], TextIndex.KIND)
+            if index is not None:
+                ids = index.find(query_set)
+                if ids is not None:
+                    return snapshot.in_order(ids)
+            return snapshot.resources
+
+        snapshot, resources = self.read(find)
+        return [resource for resource in resources if all(resource.search(qry) for qry in query_set)]
 
     #
     # Clear the resources.
     #
     def clear(self):
-        self.resources.clear()
+        with self.lock:
+            self.start_write()
+            for index in self.indexes:
+                index.build(list())
+                self.indexes_changed = True
+            self.bodies = dict()
+            self.publish(ResourceList(), IdMap())
 
     #
     # Load the collection from storage.
+    # A packed collection can be memory mapped, its resource data is then decoded when it is used.
+    # A file per resource collection is not mapped and is read as before.
+    # With a buffer pool resource data is read when it is used, see buffer_pool.py.
+    #
+    def load(self, readers=None, compressors=None, mapped=False):
+        resources = list()
+        store = get_store(self.name)
+        lazy = mapped or buffer_pool.pool is not None
+        if store is not None and lazy:
+            store.mapped = mapped
+            for entry, location in store.get_locations():
+                r = Resource(self.name)
+                r.uuid = entry
+                r.set_location((store,) + location)
+                resources.append(r)
+        elif buffer_pool.pool is not None:
+            for entry in Schema.get_resource_list(self.name):
+                if entry[0] == '.':
+                    continue
+                r = Resource(self.name)
+                r.uuid = entry
+                r.unload()
+                resources.append(r)
+        else:
+            if store is not None:
+                # Packed storage is read a segment at a time.
+                entries = store.read_all()
+            else:
+                entries = self.read_files(readers, compressors)
+
+            for entry, data in entries:
+                r = Resource(self.name)
+                r.uuid = entry
+                if store is not None:
+                    r.set_record(data)
+                else:
+                    r.data = data
+                r.state = Schema.LOADED
+                resources.append(r)
+        with self.lock:
+            self.start_write()
+            self.indexes = list()
+            self.bodies = dict()
+            self.share(resources)
+            self.publish(ResourceList.from_list(resources),
+                         IdMap.from_items((str(resource.uuid), resource) for resource in resources))
+            self.indexes, self.indexes_changed = load_indexes(self)
+            self.publish(self.resources, self.ids)
+
+    #
+    # Point memory mapped resources at their new location after the store is compacted.
+    #
+    def relocate(self, store):
+        for resource in self.resources:
+            if resource.location is not None:
+                resource.set_location((store,) + store.offsets[str(resource.uuid)])
+
     #
-    def load(self):
-        dir_list = Schema.get_resource_list(self.name)
-        self.resources.clear()
-        for entry in dir_list:
-            if entry[0] == '.':
-                # Skip directories.
+    # Read the resource files of the collection and return a list of (id, data).
+    # When a readers thread pool is given the files are read concurrently,
+    # and large collections have their whitespace removed by the compressors process pool.
+    #
+    def read_files(self, readers=None, compressors=None):
+        dir_list = [entry for entry in Schema.get_resource_list(self.name) if entry[0] != '.']
+        path = os.path.join(Schema.ROOT, self.name)
+        paths = [os.path.join(path, entry) for entry in dir_list]
+        texts = readers.map(read_file, paths) if readers is not None else map(read_file, paths)
+
+        entries = list()
+        for entry, text in zip(dir_list, texts):
+            if text is None:
+                print("Resource: Load Error")
                 continue
-            r = Resource(self.name)
-            r.uuid = entry
-            r.state = Schema.LOADED
-            r.load(entry)
-            self.resources.append(r)
+            entries.append((entry, text))
+
+        texts = [text for entry, text in entries]
+        if compressors is not None and len(texts) >= PARALLEL_LOAD:
+            texts = compressors.map(compress_data, texts, chunksize=LOAD_CHUNK)
+        else:
+            texts = map(compress_data, texts)
+        return [(entry, data) for (entry, text), data in zip(entries, texts)]
 
     #
     # Save the collection to storage.
@@ -112,67 +601,33 @@ class Collection:
     # Reverse the order of a collection.
     #
     def reverse(self):
-        self.resources.reverse()
+        with self.lock:
+            self.start_write()
+            self.publish(ResourceList.from_list(list(self.resources)[::-1]), self.ids)
 
     #
     # Randomise the order of a collection.
     #
     def randomise(self):
-        random.shuffle(self.resources)
-
-        get_attribute_value(self.resources[1].data, "id")
-
-    #
-    # Sort a collection based on an attribute value.
-    # A Bubble Sort algorithm is used.
-    # THIS SORT IS TOO SLOW
-    # Takes approximately 20 seconds for 1000 records
-    # Takes approximately 5 minutes for 10000 records
-    # TODO: Implement a faster Order algorithm - see fast_sort()
-    #
-    def sort(self, attribute, reverse):
-        n = len(self.resources)
-        swapped = False
-
-        # Traverse through all collection resources.
-        for i in range(n - 1):
-            for j in range(0, n - i - 1):
-
-                # Traverse the collection from 0 to n-i-1
-                # Get the elements from the resource data.
-
-                try:
-                    # get_attribute_value is very expensive
-                    a = get_attribute_value(self.resources[j].data, attribute)
-                    b = get_attribute_value(self.resources[j + 1].data, attribute)
-                except None:
-                    print("Invalid attribute values")
-                    return
-
-                # Check a and b.
-                if a is None or b is None:
-                    print("Invalid attribute comparison")
-                    return
-
-                # Swap if the resource data attribute found is greater than the next element.
-                if a > b:
-                    swapped = True
-                    self.resources[j], self.resources[j + 1] = self.resources[j + 1], self.resources[j]
-
-            if not swapped:
-                # No swapping required.
-                return
-
-            # Reverse the order if descending.
-            if reverse:
-                self.reverse()
+        with self.lock:
+            self.start_write()
+            resources = list(self.resources)
+            random.shuffle(resources)
+            self.publish(ResourceList.from_list(resources), self.ids)
 
     #
-    # Use the python list sort method to do a very fast search.
-    # This method takes orders of magnitude less time that the linear sort() method.
+    # Sort a collection on one or more keys.
+    # Each key is an (attribute path, descending) pair, the first key is the most significant.
+    # Each key value is taken from a resource once, see query.get_sort_key().
+    # The sort is stable so the keys are applied from least to most significant.
     #
-    def fast_sort(self, attribute, reverse):
-        self.resources.sort(key=lambda data: data.get_attribute_value(attribute))
-        # Reverse the order if descending.
-        if reverse:
-            self.reverse()
+    def sort(self, keys):
+        with self.lock:
+            resources = list(self.resources)
+            documents = [resource.get_document() for resource in resources]
+            order = list(range(len(documents)))
+            for path, descending in reversed(keys):
+                column = [get_sort_key(get_path_value(document, path), descending) for document in documents]
+                order.sort(key=column.__getitem__, reverse=descending)
+            self.start_write()
+            self.publish(ResourceList.from_list([resources[i] for i in order]), self.ids)
@@ -0,0 +1,178 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+from query import get_path_value, MISSING
+
+# NumPy is optional, it is only needed by the project command.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Initial number of rows in a column.
+INITIAL_ROWS = 1024
+# Share of empty rows at which a column is compacted.
+EMPTY_SHARE = 0.5
+
+# Vectorised comparison operators, != is found by negating =.
+OPERATORS = {
+    "=": lambda x, y: x == y,
+    ">": lambda x, y: x > y,
+    ">=": lambda x, y: x >= y,
+    "<": lambda x, y: x < y,
+    "<=": lambda x, y: x <= y,
+}
+
+
+#
+# A Column is a projection of one attribute path of every resource in a collection
+# into typed NumPy arrays, so that select predicates run as vectorised masks.
+# Numbers and strings are kept in separate arrays as they are never compared with each other.
+# A column has:
+#   - The attribute path
+#   - The resource id of each row and the row of each resource id
+#   - A float array of numbers and an object array of strings
+#   - Masks of the rows that are present, numbers and strings
+#   - The empty rows left by removed resources, which are reused by the next rows added
+# The column is patched in place when resources are added or updated. An update removes the
+# resource and adds it again, so it reuses its own row and the arrays do not grow.
+# When more than EMPTY_SHARE of the rows are empty the column is compacted.
+#
+class Column:
+    KIND = "column"
+
+    def __init__(self, path):
+        self.path = list(path)
+        self.rows = dict()
+        self.free = list()
+        self.count = 0
+        self.allocate(INITIAL_ROWS)
+
+    def __str__(self):
+        return self.KIND + " on " + " ".join(self.path) + ", " + str(int(self.numbers_mask.sum())) + \
+            " numbers, " + str(int(self.strings_mask.sum())) + " strings"
+
+    # Allocate the arrays for a number of rows, keeping the rows in use.
+    def allocate(self, size):
+        ids = numpy.empty(size, dtype=object)
+        numbers = numpy.zeros(size, dtype=numpy.float64)
+        strings = numpy.full(size, "", dtype=object)
+        present = numpy.zeros(size, dtype=bool)
+        numbers_mask = numpy.zeros(size, dtype=bool)
+        strings_mask = numpy.zeros(size, dtype=bool)
+        if self.count > 0:
+            ids[:self.count] = self.ids[:self.count]
+            numbers[:self.count] = self.numbers[:self.count]
+            strings[:self.count] = self.strings[:self.count]
+            present[:self.count] = self.present[:self.count]
+            numbers_mask[:self.count] = self.numbers_mask[:self.count]
+            strings_mask[:self.count] = self.strings_mask[:self.count]
+        self.ids = ids
+        self.numbers = numbers
+        self.strings = strings
+        self.present = present
+        self.numbers_mask = numbers_mask
+        self.strings_mask = strings_mask
+
+    # Add or patch the row of a resource.
+    def add(self, resource):
+        id = str(resource.uuid)
+        row = self.rows.get(id)
+        if row is None and self.free:
+            row = self.free.pop()
+            self.rows[id] = row
+            self.ids[row] = id
+        if row is None:
+            if self.count == len(self.ids):
+                self.allocate(2 * len(self.ids))
+            row = self.count
+            self.count += 1
+            self.rows[id] = row
+            self.ids[row] = id
+
+        value = get_path_value(resource.get_document(), self.path)
+        self.present[row] = value is not MISSING
+        self.numbers_mask[row] = isinstance(value, (bool, int, float))
+        self.strings_mask[row] = isinstance(value, str)
+        self.numbers[row] = float(value) if self.numbers_mask[row] else 0.0
+        self.strings[row] = value if self.strings_mask[row] else ""
+
+    # Remove a resource id, its row is left empty for the next row added.
+    def remove(self, id):
+        row = self.rows.pop(str(id), None)
+        if row is not None:
+            self.ids[row] = None
+            self.present[row] = False
+            self.numbers_mask[row] = False
+            self.strings_mask[row] = False
+            self.free.append(row)
+            if len(self.free) > EMPTY_SHARE * max(self.count, INITIAL_ROWS):
+                self.compact()
+
+    # Move the rows in use to the start of the arrays, dropping the empty rows.
+    def compact(self):
+        used = numpy.array(sorted(self.rows.values()), dtype=numpy.int64)
+        n = len(used)
+        for values in (self.ids, self.numbers, self.strings, self.present, self.numbers_mask, self.strings_mask):
+            values[:n] = values[used]
+        self.ids[n:self.count] = None
+        self.present[n:self.count] = False
+        self.numbers_mask[n:self.count] = False
+        self.strings_mask[n:self.count] = False
+        self.rows = {id: row for row, id in enumerate(self.ids[:n].tolist())}
+        self.free = list()
+        self.count = n
+
+    # Build the column from a list of resources.
+    def build(self, resources):
+        ids = [str(resource.uuid) for resource in resources]
+        values = [get_path_value(resource.get_document(), self.path) for resource in resources]
+        numbers_mask = [isinstance(value, (bool, int, float)) for value in values]
+        strings_mask = [isinstance(value, str) for value in values]
+        n = len(values)
+
+        self.count = 0
+        self.allocate(max(INITIAL_ROWS, n))
+        self.rows = {id: row for row, id in enumerate(ids)}
+        self.free = list()
+        self.ids[:n] = ids
+        self.present[:n] = [value is not MISSING for value in values]
+        self.numbers_mask[:n] = numbers_mask
+        self.strings_mask[:n] = strings_mask
+        self.numbers[:n] = [float(value) if number else 0.0 for value, number in zip(values, numbers_mask)]
+        self.strings[:n] = [value if string else "" for value, string in zip(values, strings_mask)]
+        self.count = n
+
+    # Get the ids of the rows in a mask.
+    def get_ids(self, mask):
+        return set(self.ids[:self.count][mask].tolist())
+
+    # Find the ids of resources where the attribute operator value is true.
+    # Matches the comparison rules of query.test_attribute_value().
+    def find(self, operator, value):
+        n = self.count
+        compare = OPERATORS["=" if operator == "!=" else operator]
+        mask = self.strings_mask[:n] & compare(self.strings[:n], value).astype(bool)
+        if value.isnumeric():
+            mask |= self.numbers_mask[:n] & compare(self.numbers[:n], float(value))
+        if operator == "!=":
+            mask = self.present[:n] & ~mask
+        return self.get_ids(mask)
+
+    # Find the ids of resources where low <= attribute <= high.
+    def find_range(self, low, high):
+        n = self.count
+        numbers = self.numbers[:n]
+        return self.get_ids(self.numbers_mask[:n] & (numbers >= low) & (numbers <= high))
+
+    # Get the number of rows find() and find_range() read, every row is compared.
+    def get_cost(self, operator, value):
+        return self.count
+
+    def get_range_cost(self, low, high):
+        return self.count
+
+    # A column is not saved, project the collection again after a restart.
+    def to_json(self):
+        return None
@@ -0,0 +1,51 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import planner
+
+
+#
+# Explain command.
+# Show the compiled plan of a select and how it runs against each collection.
+# explain select|selectDistinct <qualifier> from <collection_list> [where <condition>]
+#     [order by <attribute> [asc|desc][ , ...]] [limit <n>] [offset <m>]
+#
+def explain_select(schema, command_line):
+    limits = planner.get_limit(command_line[1:])
+    if limits is None:
+        return
+    query, limit, offset = limits
+    orders = planner.get_order(query)
+    if orders is None:
+        return
+    query, keys = orders
+
+    if len(query) < 4 or (query[0] != "select" and query[0] != "selectDistinct") or query[2] != "from":
+        print("Invalid explain command - use explain select <qualifier> from <collection_list> where <condition>")
+        return
+
+    plan = None
+    if len(query) > 4:
+        if query[4] != "where" or len(query) == 5:
+            print("Invalid where clause")
+            return
+        plan = planner.cache.get(query[5:])
+        if plan is None:
+            return
+        print("Plan: " + str(plan) + (" (cached, " + str(plan.hits) + " hits)" if plan.hits > 0 else " (compiled)"))
+
+    if keys is not None:
+        print("Order by: " + " , ".join(" ".join(path) + (" desc" if descending else "") for path, descending in keys))
+    if limit is not None or offset > 0:
+        print("Limit: " + ("none" if limit is None else str(limit)) + ", offset: " + str(offset))
+    for collection_name in query[3].split(','):
+        collection = schema.get_collection(collection_name)
+        if collection is None:
+            print("Invalid Collection")
+            return
+        if plan is not None:
+            for line in plan.explain(collection):
+                print(line)
+        if keys is not None:
+            print(collection.name + ": " + planner.explain_order(collection, plan, keys))
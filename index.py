@@ -0,0 +1,648 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import base64
+import hashlib
+import json
+import os
+import sys
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import accumulate, chain
+from operator import sub
+
+from query import get_path_value, get_reference, MISSING
+from schema import Schema
+
+
+# Get the index key of an attribute value.
+# Numbers are compared as floats, strings as strings and anything else as json.
+def get_key(value):
+    if isinstance(value, (bool, int, float)):
+        return "n:" + repr(float(value))
+    if isinstance(value, str):
+        return "s:" + value
+    return "j:" + json.dumps(value, sort_keys=True)
+
+
+#
+# An AttributeIndex is a hash index from attribute values to resource ids.
+# The attribute is given as a path of segments, e.g. identifier value
+# An index has:
+#   - The attribute path
+#   - A dictionary of value keys to a set of resource ids
+#   - A dictionary of resource ids to value keys
+#   - The ids changed since the index was saved, see save_indexes()
+#
+class AttributeIndex:
+    KIND = "hash"
+
+    def __init__(self, path):
+        self.path = list(path)
+        self.values = dict()
+        self.keys = dict()
+        self.changed = set()
+        self.rebuilt = True
+        self.journal = 0
+
+    def __str__(self):
+        return self.KIND + " index on " + " ".join(self.path) + ", " + str(len(self.values)) + " values"
+
+    # Add or re-index a resource.
+    def add(self, resource):
+        id = str(resource.uuid)
+        self.remove(id)
+        value = get_path_value(resource.get_document(), self.path)
+        if value is MISSING:
+            return
+        key = get_key(value)
+        self.keys[id] = key
+        self.values.setdefault(key, set()).add(id)
+
+    # Remove a resource id from the index.
+    def remove(self, id):
+        self.changed.add(str(id))
+        key = self.keys.pop(str(id), None)
+        if key is None:
+            return
+        ids = self.values[key]
+        ids.discard(str(id))
+        if not ids:
+            del self.values[key]
+
+    # Build the index from a list of resources.
+    def build(self, resources):
+        self.values.clear()
+        self.keys.clear()
+        self.rebuilt = True
+        for resource in resources:
+            self.add(resource)
+
+    # Find the ids of resources where the attribute = or != value.
+    # Matches the comparison rules of query.test_attribute_value().
+    def find(self, operator, value):
+        ids = set(self.values.get("s:" + value, ()))
+        if value.isnumeric():
+            ids |= self.values.get(get_key(float(value)), set())
+        if operator == "!=":
+            return set(self.keys) - ids
+        return ids
+
+    # Get the number of ids find() reads, without finding them.
+    def get_cost(self, operator, value):
+        if operator == "!=":
+            return len(self.keys)
+        cost = len(self.values.get("s:" + value, ()))
+        if value.isnumeric():
+            cost += len(self.values.get(get_key(float(value)), ()))
+        return cost
+
+    def to_json(self):
+        return {"kind": self.KIND, "path": self.path,
+                "values": {key: list(ids) for key, ids in self.values.items()}}
+
+    @classmethod
+    def from_json(cls, entry):
+        index = cls(entry["path"])
+        for key, ids in entry["values"].items():
+            index.values[key] = set(ids)
+            for id in ids:
+                index.keys[id] = key
+        return index
+
+
+# Sorts after every resource id, used as an inclusive upper bound.
+LAST_ID = "\U0010ffff"
+
+
+#
+# A RangeIndex keeps attribute values in sorted order so that a comparison
+# or range is answered with two binary searches.
+# Numbers and strings (including dates) are kept in separate sorted lists of
+# (value, resource id) as they are never compared with each other.
+# The ids changed since the index was saved are kept, see save_indexes().
+#
+class RangeIndex:
+    KIND = "range"
+
+    def __init__(self, path):
+        self.path = list(path)
+        self.numbers = list()
+        self.strings = list()
+        self.keys = dict()
+        self.changed = set()
+        self.rebuilt = True
+        self.journal = 0
+
+    def __str__(self):
+        return self.KIND + " index on " + " ".join(self.path) + ", " + \
+            str(len(self.numbers) + len(self.strings)) + " values"
+
+    # Get the sorted list an attribute value is kept in.
+    def get_list(self, value):
+        if isinstance(value, (bool, int, float)):
+            return self.numbers
+        if isinstance(value, str):
+            return self.strings
+        return None
+
+    # Add or re-index a resource.
+    def add(self, resource):
+        id = str(resource.uuid)
+        self.remove(id)
+        value = get_path_value(resource.get_document(), self.path)
+        if value is MISSING:
+            return
+        values = self.get_list(value)
+        if values is None:
+            # Present but never in a range.
+            self.keys[id] = None
+            return
+        if values is self.numbers:
+            value = float(value)
+        self.keys[id] = value
+        insort(values, (value, id))
+
+    # Remove a resource id from the index.
+    def remove(self, id):
+        id = str(id)
+        self.changed.add(id)
+        if id not in self.keys:
+            return
+        value = self.keys.pop(id)
+        values = self.get_list(value)
+        if values is None:
+            return
+        i = bisect_left(values, (value, id))
+        del values[i]
+
+    # Build the index from a list of resources.
+    def build(self, resources):
+        self.numbers.clear()
+        self.strings.clear()
+        self.keys.clear()
+        self.rebuilt = True
+        for resource in resources:
+            self.add(resource)
+
+    # Get the start and end of the values in a sorted list between low and high.
+    @staticmethod
+    def get_bounds(values, low, high, low_inclusive=True, high_inclusive=True):
+        start = 0
+        end = len(values)
+        if low is not None:
+            start = bisect_left(values, (low,)) if low_inclusive else bisect_right(values, (low, LAST_ID))
+        if high is not None:
+            end = bisect_right(values, (high, LAST_ID)) if high_inclusive else bisect_left(values, (high,))
+        return start, end
+
+    # Get the ids in a sorted list between low and high.
+    @staticmethod
+    def between(values, low, high, low_inclusive=True, high_inclusive=True):
+        start, end = RangeIndex.get_bounds(values, low, high, low_inclusive, high_inclusive)
+        return set(id for value, id in values[start:end])
+
+    # Get the (sorted list, bounds) of each range of values that an operator and value select.
+    def get_ranges(self, operator, value):
+        ranges = [(self.strings, value)]
+        if value.isnumeric():
+            ranges.append((self.numbers, float(value)))
+
+        bounds = list()
+        for values, y in ranges:
+            if operator == "=" or operator == "!=":
+                bounds.append((values, y, y, True, True))
+            elif operator == ">":
+                bounds.append((values, y, None, False, True))
+            elif operator == ">=":
+                bounds.append((values, y, None, True, True))
+            elif operator == "<":
+                bounds.append((values, None, y, True, False))
+            elif operator == "<=":
+                bounds.append((values, None, y, True, True))
+        return bounds
+
+    # Find the ids of resources where the attribute operator value is true.
+    # Matches the comparison rules of query.test_attribute_value().
+    def find(self, operator, value):
+        ids = set()
+        for bounds in self.get_ranges(operator, value):
+            ids |= self.between(*bounds)
+        if operator == "!=":
+            return set(self.keys) - ids
+        return ids
+
+    # Get the number of ids find() reads, without finding them.
+    def get_cost(self, operator, value):
+        if operator == "!=":
+            return len(self.keys)
+        cost = 0
+        for bounds in self.get_ranges(operator, value):
+            start, end = self.get_bounds(*bounds)
+            cost += end - start
+        return cost
+
+    # Find the ids of resources where low <= attribute <= high.
+    def find_range(self, low, high):
+        return self.between(self.numbers, low, high)
+
+    # Get the number of ids find_range() reads, without finding them.
+    def get_range_cost(self, low, high):
+        start, end = self.get_bounds(self.numbers, low, high)
+        return end - start
+
+    def to_json(self):
+        return {"kind": self.KIND, "path": self.path,
+                "values": [[value, id] for value, id in self.numbers + self.strings],
+                "other": [id for id, value in self.keys.items() if value is None]}
+
+    @classmethod
+    def from_json(cls, entry):
+        index = cls(entry["path"])
+        for value, id in entry["values"]:
+            index.get_list(value).append((value, id))
+            index.keys[id] = value
+        for id in entry["other"]:
+            index.keys[id] = None
+        return index
+
+
+# Length of the n-grams in a text index.
+GRAM_LENGTH = 3
+
+
+# Get the set of n-grams in a text.
+def get_grams(text):
+    return set(map("".join, zip(*(text[i:] for i in range(GRAM_LENGTH)))))
+
+
+# Get the digest of a resource body, resources with the same body share their trigrams in a text index.
+def get_body_digest(data):
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+# Encode a set of numbers as text: the differences of the sorted numbers are compressed, as they are mostly small.
+def encode_numbers(numbers):
+    numbers = sorted(numbers)
+    deltas = array("I", map(sub, numbers, chain((0,), numbers)))
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return base64.b64encode(zlib.compress(deltas.tobytes())).decode()
+
+
+# Decode a list of sorted numbers, see encode_numbers().
+def decode_numbers(text):
+    deltas = array("I")
+    deltas.frombytes(zlib.decompress(base64.b64decode(text)))
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return list(accumulate(deltas))
+
+
+#
+# A TextIndex is an inverted index from the trigrams of resource data to resources.
+# It narrows the resources a substring search has to check: a resource can only contain
+# a query if it contains every trigram of the query. The candidates are confirmed with find().
+# Trigrams and distinct resource bodies are numbered so that posting lists are compact sets of numbers.
+# Resources with the same body (see Collection.share()) share one body, so its trigrams are found once,
+# and the trigrams of each body are kept so that removing a resource only changes its own posting lists.
+# The number of a removed body is used again by the next new body.
+# An index has:
+#   - A dictionary of trigrams to trigram numbers
+#   - A list of the set of body numbers of each trigram (posting lists)
+#   - A list of bodies by number, [digest, array of trigram numbers, set of resource ids]
+#     or None once every resource with the body is removed
+#   - A dictionary of body digests to body numbers
+#   - A dictionary of resource ids to body numbers
+#   - A list of body numbers that are free
+#   - The ids changed since the index was saved, see save_indexes()
+#
+class TextIndex:
+    KIND = "text"
+
+    def __init__(self, path=()):
+        self.path = list()
+        self.grams = dict()
+        self.values = list()
+        self.bodies = list()
+        self.digests = dict()
+        self.keys = dict()
+        self.free = list()
+        self.changed = set()
+        self.rebuilt = True
+        self.journal = 0
+
+    def __str__(self):
+        return self.KIND + " index, " + str(len(self.grams)) + " trigrams, " + \
+            str(len(self.digests)) + " distinct bodies"
+
+    # Add a body with a list of trigram numbers, return the body number.
+    def add_body(self, digest, grams):
+        number = self.free.pop() if self.free else len(self.bodies)
+        if number == len(self.bodies):
+            self.bodies.append(None)
+        self.bodies[number] = [digest, array("I", grams), set()]
+        self.digests[digest] = number
+        values = self.values
+        for gram in grams:
+            values[gram].add(number)
+        return number
+
+    # Add or re-index a resource.
+    def add(self, resource):
+        id = str(resource.uuid)
+        self.remove(id)
+        data = resource.data
+        digest = get_body_digest(data)
+        number = self.digests.get(digest)
+        if number is None:
+            grams = get_grams(data)
+            numbers = list(map(self.grams.get, grams))
+            if None in numbers:
+                for gram in grams:
+                    if gram not in self.grams:
+                        self.grams[gram] = len(self.values)
+                        self.values.append(set())
+                numbers = list(map(self.grams.get, grams))
+            number = self.add_body(digest, numbers)
+        self.bodies[number][2].add(id)
+        self.keys[id] = number
+
+    # Remove a resource id from the index.
+    # The posting lists of its body are changed once no other resource has the body.
+    def remove(self, id):
+        id = str(id)
+        self.changed.add(id)
+        number = self.keys.pop(id, None)
+        if number is None:
+            return
+        digest, grams, ids = self.bodies[number]
+        ids.discard(id)
+        if ids:
+            return
+        values = self.values
+        for gram in grams:
+            values[gram].discard(number)
+        del self.digests[digest]
+        self.bodies[number] = None
+        self.free.append(number)
+
+    # Build the index from a list of resources.
+    def build(self, resources):
+        self.grams.clear()
+        self.values.clear()
+        self.bodies.clear()
+        self.digests.clear()
+        self.keys.clear()
+        self.free.clear()
+        self.rebuilt = True
+        for resource in resources:
+            self.add(resource)
+
+    #
+    # Find the ids of resources that may contain every query in a query set.
+    # The posting lists are intersected from the shortest.
+    # Return None if no query is long enough to use the index.
+    #
+    def find(self, query_set):
+        grams = set()
+        for query in query_set:
+            grams |= get_grams(query)
+        if not grams:
+            return None
+        if any(gram not in self.grams for gram in grams):
+            return set()
+
+        postings = sorted((self.values[self.grams[gram]] for gram in grams), key=len)
+        numbers = set(postings[0])
+        for posting in postings[1:]:
+            if not numbers:
+                break
+            numbers &= posting
+        return {id for number in numbers for id in self.bodies[number][2]}
+
+    # The trigrams are saved in number order and each body with its trigram numbers and resource ids.
+    def to_json(self):
+        return {"kind": self.KIND, "path": self.path, "grams": list(self.grams),
+                "bodies": [[digest, encode_numbers(grams), list(ids)]
+                           for digest, grams, ids in filter(None, self.bodies)]}
+
+    @classmethod
+    def from_json(cls, entry):
+        index = cls()
+        index.grams = {gram: number for number, gram in enumerate(entry["grams"])}
+        index.values = [set() for gram in index.grams]
+        for digest, grams, ids in entry["bodies"]:
+            number = index.add_body(digest, decode_numbers(grams))
+            index.bodies[number][2].update(ids)
+            for id in ids:
+                index.keys[id] = number
+        return index
+
+
+# Get the key of a reference target, e.g. Patient/123, or 123 when the type is not known.
+def get_reference_key(resource_type, id):
+    return id if resource_type is None else resource_type + "/" + id
+
+
+# Get the keys of the targets of every reference in a document, see query.get_reference().
+def get_reference_keys(document):
+    keys = set()
+    parts = [document]
+    while parts:
+        part = parts.pop()
+        if isinstance(part, dict):
+            reference = part.get("reference")
+            if isinstance(reference, str):
+                keys.add(get_reference_key(*get_reference(reference)))
+            parts.extend(value for value in part.values() if isinstance(value, (dict, list)))
+        elif isinstance(part, list):
+            parts.extend(part)
+    return keys
+
+
+#
+# A ReferenceIndex is a reverse reference index from the targets of the references in a collection
+# (every reference field, e.g. Observation subject and performer) to the resources that refer to them.
+# An index has:
+#   - A dictionary of target keys to a set of referring resource ids, see get_reference_key()
+#   - A dictionary of resource ids to their target keys
+#   - The ids changed since the index was saved, see save_indexes()
+#
+class ReferenceIndex:
+    KIND = "reference"
+
+    def __init__(self, path=()):
+        self.path = list()
+        self.values = dict()
+        self.keys = dict()
+        self.changed = set()
+        self.rebuilt = True
+        self.journal = 0
+
+    def __str__(self):
+        return self.KIND + " index, " + str(len(self.values)) + " referenced resources"
+
+    # Add or re-index a resource.
+    def add(self, resource):
+        id = str(resource.uuid)
+        self.remove(id)
+        keys = get_reference_keys(resource.get_document())
+        if not keys:
+            return
+        self.keys[id] = keys
+        for key in keys:
+            self.values.setdefault(key, set()).add(id)
+
+    # Remove a resource id from the index.
+    def remove(self, id):
+        self.changed.add(str(id))
+        keys = self.keys.pop(str(id), None)
+        if keys is None:
+            return
+        for key in keys:
+            ids = self.values[key]
+            ids.discard(str(id))
+            if not ids:
+                del self.values[key]
+
+    # Build the index from a list of resources.
+    def build(self, resources):
+        self.values.clear()
+        self.keys.clear()
+        self.rebuilt = True
+        for resource in resources:
+            self.add(resource)
+
+    # Find the ids of resources that refer to any of a list of target keys.
+    def find(self, keys):
+        ids = set()
+        for key in keys:
+            ids |= self.values.get(key, set())
+        return ids
+
+    def to_json(self):
+        return {"kind": self.KIND, "path": self.path,
+                "values": {key: list(ids) for key, ids in self.values.items()}}
+
+    @classmethod
+    def from_json(cls, entry):
+        index = cls()
+        for key, ids in entry["values"].items():
+            index.values[key] = set(ids)
+            for id in ids:
+                index.keys.setdefault(id, set()).add(key)
+        return index
+
+
+# Index types by kind.
+INDEX_TYPES = {AttributeIndex.KIND: AttributeIndex, RangeIndex.KIND: RangeIndex, TextIndex.KIND: TextIndex,
+               ReferenceIndex.KIND: ReferenceIndex}
+
+
+# Save a whole index again when its journal has changed more than this share of the resources,
+JOURNAL_SHARE = 0.1
+
+# ... or this many resources, whichever is more.
+JOURNAL_SIZE = 1000
+
+
+#
+# Each index is stored in a file next to the collection directory, named by its kind and path,
+# e.g. Collection/Patient.hash.gender.index
+# Changes made after the index was saved are appended to a journal, the index file name + ".log",
+# as lines of the ids that changed. The journal is applied when the index is loaded.
+#
+def get_index_file(collection_name, index):
+    return os.path.join(Schema.ROOT, ".".join([collection_name, index.KIND] + index.path) + ".index")
+
+
+# Write a file so it is replaced whole, a crash leaves the old file.
+def write_file(path, text):
+    with open(path + ".tmp", "w") as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+#
+# Save the indexes of a collection that have changed.
+# An index is written whole (when it is new, rebuilt, or its journal has grown too long),
+# otherwise the ids changed since it was saved are appended to its journal.
+#
+def save_indexes(collection):
+    count = len(collection.resources)
+    try:
+        for index in collection.indexes:
+            if index.KIND not in INDEX_TYPES or not (index.rebuilt or index.changed):
+                continue
+            path = get_index_file(collection.name, index)
+            if index.rebuilt or index.journal + len(index.changed) > max(JOURNAL_SIZE, JOURNAL_SHARE * count):
+                entry = index.to_json()
+                entry["count"] = count
+                write_file(path, json.dumps(entry))
+                if os.path.exists(path + ".log"):
+                    os.remove(path + ".log")
+                index.journal = 0
+            else:
+                with open(path + ".log", "a") as file:
+                    file.write(json.dumps({"count": count, "ids": sorted(index.changed)}) + "\n")
+                index.journal += len(index.changed)
+            index.changed.clear()
+            index.rebuilt = False
+    except IOError:
+        print("Index: Save Error")
+
+
+#
+# Load an index from its file and journal.
+# An index that cannot be read or does not match the loaded resources is rebuilt.
+#
+def load_index(collection, index_type, path, file_name):
+    try:
+        with open(file_name, "r") as file:
+            entry = json.load(file)
+        index = index_type.from_json(entry)
+        count = entry["count"]
+        if os.path.exists(file_name + ".log"):
+            with open(file_name + ".log", "r") as file:
+                for line in file:
+                    change = json.loads(line)
+                    for id in change["ids"]:
+                        index.remove(id)
+                        if id in collection.ids:
+                            index.add(collection.ids[id])
+                    count = change["count"]
+                    index.journal += len(change["ids"])
+        valid = count == len(collection.resources) and all(id in collection.ids for id in index.keys)
+    except (ValueError, KeyError, TypeError):
+        print("Index: Load Error", file_name)
+        index = index_type(path)
+        valid = False
+    if valid:
+        index.changed.clear()
+        index.rebuilt = False
+    else:
+        index.build(collection.resources)
+    return index
+
+
+#
+# Load the indexes of a collection from their files.
+# Return the indexes and True if any must be saved.
+#
+def load_indexes(collection):
+    indexes = list()
+    prefix = collection.name + "."
+    for entry in sorted(os.listdir(Schema.ROOT)):
+        if not entry.startswith(prefix) or not entry.endswith(".index"):
+            continue
+        parts = entry[len(prefix):-len(".index")].split(".")
+        index_type = INDEX_TYPES.get(parts[0])
+        if index_type is None:
+            continue
+        indexes.append(load_index(collection, index_type, parts[1:], os.path.join(Schema.ROOT, entry)))
+    return indexes, any(index.rebuilt for index in indexes)
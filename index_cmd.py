@@ -0,0 +1,96 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import column
+from index import AttributeIndex, RangeIndex, ReferenceIndex, TextIndex
+
+# Index types by create command.
+INDEX_COMMANDS = {"index": AttributeIndex, "rangeIndex": RangeIndex}
+
+# Index types of whole resources by create command.
+RESOURCE_INDEX_COMMANDS = {"textIndex": TextIndex, "referenceIndex": ReferenceIndex}
+
+
+#
+# Create index command.
+# create index|rangeIndex <collection> on <attribute>
+# create index|rangeIndex <collection> on <segment> <attribute>
+# create index|rangeIndex <collection> on <segment1> with <segment2> <attribute>
+#
+
+def create_index(schema, command_line):
+    if len(command_line) < 5:
+        print("Invalid create index command - too few arguments")
+        return
+
+    collection = schema.get_collection(command_line[2])
+    if collection is None:
+        print("Invalid Collection")
+        return
+
+    if command_line[3] != "on":
+        print("Invalid create index command - use the on keyword")
+        return
+
+    path = [token for token in command_line[4:] if token != "with"]
+    if len(path) == 0:
+        print("Invalid create index command - attribute missing")
+        return
+
+    index = collection.create_index(path, INDEX_COMMANDS[command_line[1]])
+    print(index)
+
+
+#
+# Create text or reference index command.
+# A text index has the trigrams of every resource for search.
+# A reference index has the resources that refer to each resource, for get ... revinclude.
+# create textIndex|referenceIndex <collection>
+#
+def create_resource_index(schema, command_line):
+    if len(command_line) < 3:
+        print("Invalid create " + command_line[1] + " command - collection missing")
+        return
+
+    collection = schema.get_collection(command_line[2])
+    if collection is None:
+        print("Invalid Collection")
+        return
+
+    index = collection.create_index([], RESOURCE_INDEX_COMMANDS[command_line[1]])
+    print(index)
+
+
+#
+# Project collection command.
+# Project an attribute of every resource into a NumPy column for vectorised selects.
+# project <collection> on <attribute>
+# project <collection> on <segment> <attribute>
+# project <collection> on <segment1> with <segment2> <attribute>
+#
+def project_collection(schema, command_line):
+    if column.numpy is None:
+        print("The project command requires NumPy - pip install numpy")
+        return
+
+    if len(command_line) < 4:
+        print("Invalid project command - too few arguments")
+        return
+
+    collection = schema.get_collection(command_line[1])
+    if collection is None:
+        print("Invalid Collection")
+        return
+
+    if command_line[2] != "on":
+        print("Invalid project command - use the on keyword")
+        return
+
+    path = [token for token in command_line[3:] if token != "with"]
+    if len(path) == 0:
+        print("Invalid project command - attribute missing")
+        return
+
+    projection = collection.create_index(path, column.Column)
+    print(projection)
@@ -0,0 +1,117 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+from index import AttributeIndex, ReferenceIndex, get_reference_key, get_reference_keys
+from query import get_path_value, get_reference, MISSING
+
+
+#
+# Get the join key of a document: the (resource type, id) the attribute at the end of a path refers to.
+# A reference is normalised to its target, see query.get_reference(), and a Reference
+# object (e.g. subject) is followed to its reference.
+# The id of a resource has the type of the resource.
+# Return None if the attribute is missing or is not a reference.
+#
+def get_join_key(document, path):
+    value = get_path_value(document, path)
+    if isinstance(value, dict):
+        value = value.get("reference", MISSING)
+    if value is MISSING or value is None or isinstance(value, (dict, list)):
+        return None
+    if path == ["id"]:
+        return document.get("resourceType"), str(value)
+    return get_reference(value)
+
+
+#
+# Join two lists of resources where the attribute at the end of left_path refers to the same
+# resource as the attribute at the end of right_path, e.g. subject reference = id.
+# A hash table is built on the smaller list and probed with the larger one, so the join is O(n + m).
+# Keys match when their ids are equal and their resource types are equal or not known.
+# Return a list of (left resource, right resource) pairs in left order, then right order.
+#
+def hash_join(left, left_path, right, right_path):
+    swap = len(right) < len(left)
+    if swap:
+        build, build_path, probe, probe_path = right, right_path, left, left_path
+    else:
+        build, build_path, probe, probe_path = left, left_path, right, right_path
+
+    table = dict()
+    for i, resource in enumerate(build):
+        key = get_join_key(resource.get_document(), build_path)
+        if key is not None:
+            table.setdefault(key[1], list()).append((key[0], i, resource))
+
+    pairs = list()
+    for resource in probe:
+        key = get_join_key(resource.get_document(), probe_path)
+        if key is None:
+            continue
+        for resource_type, i, match in table.get(key[1], ()):
+            if key[0] is None or resource_type is None or key[0] == resource_type:
+                pairs.append((i, resource, match))
+
+    if swap:
+        # Probed in left order, the matches of each left resource are in right order.
+        return [(resource, match) for i, resource, match in pairs]
+    # Probed in right order, a stable sort on the left position keeps right order for each left resource.
+    pairs.sort(key=lambda pair: pair[0])
+    return [(match, resource) for i, resource, match in pairs]
+
+
+#
+# Get the resources of a collection that refer to a resource, in collection order (FHIR _revinclude).
+# A reference may name the resource by its id or by its uuid, with or without the resource type.
+# The referring resources are found with the collection's reference index (create referenceIndex),
+# without one the references of every resource are read.
+#
+def get_revincludes(resource, collection):
+    document = resource.get_document()
+    resource_type = document.get("resourceType") if isinstance(document, dict) else None
+    ids = [str(resource.uuid)]
+    id = get_path_value(document, ["id"])
+    if id is not MISSING and id is not None:
+        ids.append(str(id))
+    keys = [get_reference_key(None, id) for id in ids]
+    if resource_type is not None:
+        keys += [get_reference_key(resource_type, id) for id in ids]
+
+    def find(snapshot):
+        index = snapshot.get_index([], ReferenceIndex.KIND)
+        if index is not None:
+            return snapshot.in_order(index.find(keys))
+        targets = set(keys)
+        return [resource for resource in snapshot.resources
+                if not targets.isdisjoint(get_reference_keys(resource.get_document()))]
+    return collection.read(find)[1]
+
+
+#
+# Get the resources of a collection that a resource refers to, in collection order (FHIR _include).
+# References are found with the collection's hash index on id (create index <collection> on id),
+# without one the id of every resource is read.
+#
+def get_includes(resource, collection):
+    references = [get_reference(key) for key in get_reference_keys(resource.get_document())]
+
+    def find(snapshot):
+        index = snapshot.get_index(["id"], AttributeIndex.KIND)
+        by_id = dict()
+        if index is None:
+            for resource in snapshot.resources:
+                value = get_path_value(resource.get_document(), ["id"])
+                if value is not MISSING and value is not None:
+                    by_id.setdefault(str(value), []).append(str(resource.uuid))
+        ids = set()
+        for resource_type, id in references:
+            if id in snapshot.ids:
+                # A reference to the uuid of a resource.
+                ids.add(id)
+            for match in by_id.get(id, ()) if index is None else index.find("=", id):
+                if resource_type is None or \
+                        snapshot.ids[match].get_document().get("resourceType") == resource_type:
+                    ids.add(match)
+        return snapshot.in_order(ids)
+    return collection.read(find)[1]
@@ -0,0 +1,83 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+from itertools import islice
+
+import planner
+from join import hash_join
+
+
+#
+# Join command, a select that relates the resources of two collections, see join.py.
+# select <qualifier> from <collection> join <collection> on <attribute> = <attribute> [where <condition>]
+# e.g. select * from Observation join Patient on subject reference = id where status = final
+# The where clause selects resources of the first collection.
+# query is the select command without its limit and offset.
+#
+def join_select(schema, query, limit, offset):
+    if len(query) < 10 or query[6] != "on":
+        print("Invalid join - use <collection> join <collection> on <attribute> = <attribute>")
+        return
+
+    left = schema.get_collection(query[3])
+    right = schema.get_collection(query[5])
+    if left is None or right is None:
+        print("Invalid Collection")
+        return
+
+    condition = query[7:]
+    where = condition.index("where") if "where" in condition else len(condition)
+    if "=" not in condition[:where]:
+        print("Invalid join - use on <attribute> = <attribute>")
+        return
+    equals = condition.index("=")
+    left_path = [token for token in condition[:equals] if token != "with"]
+    right_path = [token for token in condition[equals + 1:where] if token != "with"]
+    if len(left_path) == 0 or len(right_path) == 0:
+        print("Invalid join - attribute missing")
+        return
+
+    left_resources = left.resources
+    if where < len(condition):
+        plan = planner.cache.get(condition[where + 1:])
+        if plan is None:
+            return
+        left_resources = list(plan.select(left))
+
+    pairs = hash_join(left_resources, left_path, right.resources, right_path)
+    if limit is not None:
+        pairs = pairs[:offset + limit]
+    print_join(schema, query[1], pairs[offset:])
+
+
+#
+# Print the (left resource, right resource) pairs of a join.
+#
+def print_join(schema, qualifier, pairs):
+    if qualifier == "count":
+        print(len(pairs))
+        return
+
+    temp_results = schema.get_collection("Result")
+    if temp_results is None:
+        print("Invalid Collection")
+        return
+
+    printed = list()
+    for left, right in islice(pairs, schema.number_of_results):
+        if qualifier == "*":
+            print(left)
+            print("    " + str(right))
+            printed += [left, right]
+        elif qualifier == "id":
+            print(str(left.uuid) + ", " + str(right.uuid))
+            printed += [left.uuid, right.uuid]
+        elif qualifier == "data":
+            print(left.data)
+            print("    " + right.data)
+            printed += [left.uuid, right.uuid]
+        else:
+            print("print_join(): Invalid select qualifier")
+            return
+    temp_results.add_results(printed)
@@ -3,26 +3,39 @@ FHIR Server Proof of Concept
 Author: Tim Hastings, 2023
 """
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 
 from collection import Collection
 
+
 #
 # Load the Schema.
+# With more than one worker resource files are read by a thread pool
+# and their whitespace is removed by a process pool.
+# When mapped is set packed collections are memory mapped instead of read.
 #
-def load(schema):
+def load(schema, workers=1, mapped=False):
+    readers = None
+    compressors = None
     try:
         # Get the start time.
         start = datetime.now()
         schema.collections.clear()
-        dirs = os.walk(schema.ROOT)
-        for directory in dirs:
-            entry = directory[0].split('/')
-            if len(entry) > 1:
-                print("Loading", entry[1])
-                collection = Collection(entry[1])
-                collection.load()
-                schema.collections.append(collection)
+        if workers > 1:
+            readers = ThreadPoolExecutor(max_workers=workers)
+            compressors = ProcessPoolExecutor(max_workers=workers)
+        for entry in sorted(os.listdir(schema.ROOT)):
+            if not os.path.isdir(os.path.join(schema.ROOT, entry)):
+                # Skip index and other collection files.
+                continue
+            print("Loading", entry)
+            collection_start = datetime.now()
+            collection = Collection(entry)
+            collection.load(readers, compressors, mapped)
+            schema.collections.append(collection)
+            td = (datetime.now() - collection_start).total_seconds() * 10 ** 3
+            print(f"Loaded {entry}: {len(collection.resources)} entries in {td:.02f} ms")
 
         # Find the start to end time difference and display.
         end = datetime.now()
@@ -34,5 +47,8 @@ def load(schema):
         print("Create a root directory called Collection.")
         print("Each collection is a sub directory and resources are files within the collection.")
         exit(0)
+    finally:
+        if readers is not None:
+            readers.shutdown()
+            compressors.shutdown()
     print("Ready")
-
@@ -2,14 +2,45 @@
 FHIR Server Proof of Concept
 Author: Tim Hastings, 2023
 """
+import argparse
+import os
 
+import buffer_pool
 import cli
 import loader
+import scatter
+import server
 from schema import Schema
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="FHIR Server POC")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of workers used to load collections")
+    parser.add_argument("--mmap", action="store_true",
+                        help="memory map packed collections and decode resources when they are used")
+    parser.add_argument("--memory-limit",
+                        help="memory budget for resource data, e.g. 512MB, see buffer_pool.py")
+    parser.add_argument("--parallel", type=int, default=0,
+                        help="number of worker processes used to scan packed collections, see scatter.py")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="serve the FHIR REST API on a port instead of running the command line, see server.py")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="host address the FHIR REST API is served on")
+    args = parser.parse_args()
+
+    if args.memory_limit is not None:
+        limit = buffer_pool.parse_size(args.memory_limit)
+        if limit is None:
+            parser.error("invalid memory limit " + args.memory_limit)
+        buffer_pool.pool = buffer_pool.BufferPool(limit)
     schema = Schema("FHIR Server POC")
     # Load the schema
-    loader.load(schema)
-    # Run the command line interface
-    cli.cli(schema)
+    loader.load(schema, args.workers, args.mmap)
+    if args.parallel > 1:
+        scatter.pool = scatter.ScatterPool(args.parallel, scatter.get_packed(schema))
+    if args.serve is not None:
+        # Serve the FHIR REST API
+        server.serve(schema, args.host, args.serve)
+    else:
+        # Run the command line interface
+        cli.cli(schema)
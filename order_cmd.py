@@ -1,30 +1,48 @@
 #
 # Order collection command.
-# order <collection> on <attribute>
-# order <collection> on <segment> <attribute>
-# order <collection> on <segment1> with <segment2> on <attribute>
+# order <collection> on <attribute> [asc|desc]
+# order <collection> on <segment> <attribute> [asc|desc]
+# order <collection> on <segment1> with <segment2> <attribute> [asc|desc]
+# Order on several keys by separating them with a comma, e.g.
+# order Patient on gender , birthDate desc
 #
 
+# Parse the sort keys after the on keyword.
+# Return a list of (attribute path, descending) or None if a key is invalid.
+def get_order_keys(tokens):
+    keys = list()
+    for part in " ".join(tokens).split(","):
+        path = [token for token in part.split() if token != "with"]
+        descending = False
+        if len(path) > 0 and (path[-1] == "asc" or path[-1] == "desc"):
+            descending = path.pop() == "desc"
+        if len(path) == 0:
+            return None
+        keys.append((path, descending))
+    return keys
+
+
 def order_collection(schema, command_line):
     # order <collection> on <attribute>
-    if len(command_line) < 3:
+    if len(command_line) < 4:
         print("Invalid order command - too few arguments")
         return
 
     collection_name = command_line[1]
     print(collection_name)
     collection = schema.get_collection(collection_name)
-    id = command_line[3]
 
     if collection is None:
         print("Invalid Collection")
         return
 
-    # TODO check id
-    # TODO more validation
-    if command_line[0] == "order":
-        collection.sort(id, False)
-    collection.fast_sort(id, False)
-
+    if command_line[2] != "on":
+        print("Invalid order command - use the on keyword")
+        return
 
+    keys = get_order_keys(command_line[3:])
+    if keys is None:
+        print("Invalid order command - attribute missing")
+        return
 
+    collection.sort(keys)
@@ -0,0 +1,640 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import heapq
+from collections import OrderedDict
+from itertools import groupby, islice
+from operator import eq, ge, gt, itemgetter, le, lt, ne
+
+import scatter
+from order_cmd import get_order_keys
+from query import get_path_value, get_range_index, get_segment, get_sort_key, get_value_index
+
+# Comparison operators, see query.test_attribute_value().
+OPERATORS = {"=": eq, "!=": ne, ">": gt, ">=": ge, "<": lt, "<=": le}
+
+# Words of the where clause that cannot be part of an attribute path.
+KEYWORDS = ("and", "or", "(", ")", ":")
+
+# Number of compiled plans kept in the plan cache.
+PLAN_CACHE_SIZE = 256
+
+
+# Raised when a where clause cannot be parsed.
+class QueryError(Exception):
+    pass
+
+
+#
+# Compile a function that follows an attribute path in a document, see query.get_path_value().
+# Return the function, which raises LookupError or TypeError when the attribute is not found.
+#
+def compile_path(path):
+    segments = tuple(path[:-1])
+    attribute = path[-1]
+    if len(segments) == 0:
+        return lambda document: document[attribute]
+
+    def get_value(document):
+        part = document
+        for segment in segments:
+            part = get_segment(part, segment)
+        return part[attribute]
+    return get_value
+
+
+#
+# Combine a list of document tests into one test that is true when every test is true.
+# Return None for an empty list.
+#
+def all_of(tests):
+    if len(tests) == 0:
+        return None
+    if len(tests) == 1:
+        return tests[0]
+    if len(tests) == 2:
+        first, second = tests
+        return lambda document: first(document) and second(document)
+    return lambda document: all(test(document) for test in tests)
+
+
+#
+# The where clause of a select is parsed into a tree of nodes.
+# Each node compiles to a test, a closure that takes a parsed document and returns True or False,
+# and knows how to use the collection indexes (access) and how to describe itself (explain).
+# compile() sets the test of the node and its children, and is called once the node is used by a Plan.
+# access(collection) returns (ids, residual):
+#   - ids is the set of resource ids the indexes allow, None if the indexes cannot help
+#   - residual is the test still to be applied to those resources, None if there is nothing to test
+# get_cost(collection) returns the number of ids the indexes read to answer the node, without
+# reading them, or None when the indexes cannot answer the node without a test.
+#
+
+#
+# A Comparison node tests an attribute path with an operator and value.
+# Matches the comparison rules of query.test_attribute_value():
+# a value that is a number is compared as a number with an attribute that is not a string.
+#
+class Comparison:
+
+    def __init__(self, path, operator, value):
+        self.path = path
+        self.operator = operator
+        self.value = value
+        self.test = None
+
+    def __str__(self):
+        return " ".join(self.path) + " " + self.operator + " " + self.value
+
+    def compile(self):
+        get_value = compile_path(self.path)
+        compare = OPERATORS[self.operator]
+        value = self.value
+        number = float(value) if value.isnumeric() else None
+
+        def test(document):
+            try:
+                x = get_value(document)
+                return compare(x, value if number is None or type(x) == str else number)
+            except (LookupError, TypeError):
+                return False
+        self.test = test
+        return test
+
+    def get_index(self, collection):
+        return get_value_index(collection, self.path, self.operator)
+
+    def access(self, collection):
+        index = self.get_index(collection)
+        if index is None:
+            return None, self.test
+        return index.find(self.operator, self.value), None
+
+    def get_cost(self, collection):
+        index = self.get_index(collection)
+        if index is None:
+            return None
+        return index.get_cost(self.operator, self.value)
+
+    def explain(self, collection, depth):
+        index = self.get_index(collection)
+        return ["    " * depth + str(self) + "  [" + (str(index) if index is not None else "scan") + "]"]
+
+
+#
+# A Range node tests that a number attribute is between low and high inclusive.
+#
+class Range:
+
+    def __init__(self, path, low, high):
+        self.path = path
+        self.low = low
+        self.high = high
+        self.test = None
+
+    def __str__(self):
+        return " ".join(self.path) + " = " + repr(self.low) + " : " + repr(self.high)
+
+    def compile(self):
+        get_value = compile_path(self.path)
+        low = self.low
+        high = self.high
+
+        def test(document):
+            try:
+                return low <= get_value(document) <= high
+            except (LookupError, TypeError):
+                return False
+        self.test = test
+        return test
+
+    def get_index(self, collection):
+        return get_range_index(collection, self.path)
+
+    def access(self, collection):
+        index = self.get_index(collection)
+        if index is None:
+            return None, self.test
+        return index.find_range(self.low, self.high), None
+
+    def get_cost(self, collection):
+        index = self.get_index(collection)
+        if index is None:
+            return None
+        return index.get_range_cost(self.low, self.high)
+
+    def explain(self, collection, depth):
+        index = self.get_index(collection)
+        return ["    " * depth + str(self) + "  [" + (str(index) if index is not None else "scan") + "]"]
+
+
+# Get the total cost of a list of nodes, None if any node cannot be answered by the indexes.
+def get_total_cost(nodes, collection):
+    total = 0
+    for node in nodes:
+        cost = node.get_cost(collection)
+        if cost is None:
+            return None
+        total += cost
+    return total
+
+
+#
+# An And node is true when every child is true.
+# The ids of the indexed children are intersected and the other children are tested.
+#
+class And:
+
+    def __init__(self, children):
+        self.children = children
+        self.test = None
+
+    def __str__(self):
+        return "(" + " and ".join(str(child) for child in self.children) + ")"
+
+    def compile(self):
+        self.test = all_of([child.compile() for child in self.children])
+        return self.test
+
+    def access(self, collection):
+        ids = None
+        residuals = list()
+        for child in self.children:
+            child_ids, residual = child.access(collection)
+            if child_ids is not None:
+                ids = child_ids if ids is None else ids & child_ids
+            if residual is not None:
+                residuals.append(residual)
+        if ids is None:
+            return None, self.test
+        return ids, all_of(residuals)
+
+    # Every child must be answered by the indexes for the node to need no test.
+    def get_cost(self, collection):
+        return get_total_cost(self.children, collection)
+
+    def explain(self, collection, depth):
+        lines = ["    " * depth + "and"]
+        for child in self.children:
+            lines += child.explain(collection, depth + 1)
+        return lines
+
+
+#
+# An Or node is true when any child is true.
+# The indexes are only used when every child is answered by an index, the ids are then combined.
+#
+class Or:
+
+    def __init__(self, children):
+        self.children = children
+        self.test = None
+
+    def __str__(self):
+        return "(" + " or ".join(str(child) for child in self.children) + ")"
+
+    def compile(self):
+        tests = [child.compile() for child in self.children]
+        self.test = lambda document: any(test(document) for test in tests)
+        return self.test
+
+    def access(self, collection):
+        ids = set()
+        for child in self.children:
+            child_ids, residual = child.access(collection)
+            if child_ids is None or residual is not None:
+                return None, self.test
+            ids |= child_ids
+        return ids, None
+
+    def get_cost(self, collection):
+        return get_total_cost(self.children, collection)
+
+    def explain(self, collection, depth):
+        lines = ["    " * depth + "or"]
+        for child in self.children:
+            lines += child.explain(collection, depth + 1)
+        return lines
+
+
+#
+# Parse the tokens of a where clause into a tree of nodes.
+# condition  :: term [or term ...]
+# term       :: factor [and factor ...]
+# factor     :: ( condition ) | comparison
+# comparison :: <path> <operator> <value> | <path> = <low> : <high>
+# path       :: <segment> [[with] <segment> ...] [with] <attribute>
+# Tokens are separated by spaces, including ( and ). with between the segments of a path is dropped,
+# a value of with is kept.
+#
+class Parser:
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self, expected):
+        token = self.peek()
+        if token is None:
+            raise QueryError(expected + " missing")
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self.parse_condition()
+        if self.peek() is not None:
+            raise QueryError("unexpected " + self.peek())
+        return node
+
+    def parse_condition(self):
+        nodes = [self.parse_term()]
+        while self.peek() == "or":
+            self.position += 1
+            nodes.append(self.parse_term())
+        return nodes[0] if len(nodes) == 1 else Or(nodes)
+
+    def parse_term(self):
+        nodes = [self.parse_factor()]
+        while self.peek() == "and":
+            self.position += 1
+            nodes.append(self.parse_factor())
+        return nodes[0] if len(nodes) == 1 else And(nodes)
+
+    def parse_factor(self):
+        if self.peek() == "(":
+            self.position += 1
+            node = self.parse_condition()
+            if self.next(")") != ")":
+                raise QueryError(") missing")
+            return node
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        path = list()
+        while self.peek() is not None and self.peek() not in OPERATORS:
+            token = self.next("attribute")
+            if token in KEYWORDS:
+                raise QueryError("unexpected " + token)
+            if token == "with" and len(path) > 0 and self.peek() is not None and self.peek() not in OPERATORS:
+                continue
+            path.append(token)
+        if len(path) == 0:
+            raise QueryError("attribute missing")
+
+        operator = self.next("operator")
+        value = self.next("value")
+        if self.peek() != ":":
+            return Comparison(path, operator, value)
+
+        self.position += 1
+        high = self.next("range high value")
+        if operator != "=":
+            raise QueryError("use = <low> : <high> for a range")
+        try:
+            low = float(value)
+            high = float(high)
+        except ValueError:
+            raise QueryError("range is not a number")
+        if low > high:
+            raise QueryError("range low value must be less than or equal to high value")
+        return Range(path, low, high)
+
+
+# A collection is scanned in parallel when a scatter pool is running and accepts it, see scatter.py.
+def scatter_accepts(collection):
+    return scatter.pool is not None and scatter.pool.accepts(collection)
+
+
+#
+# Split the limit n and offset m clauses from the end of a select query.
+# Return the query without them, the limit (None for no limit) and the offset,
+# or None if a clause is invalid.
+#
+def get_limit(query):
+    limit = None
+    offset = 0
+    while len(query) > 5 and (query[-2] == "limit" or query[-2] == "offset"):
+        try:
+            n = int(query[-1])
+        except ValueError:
+            print("Invalid " + query[-2] + " - not a number")
+            return None
+        if n < 0:
+            print("Invalid " + query[-2] + " - must not be negative")
+            return None
+        if query[-2] == "limit":
+            limit = n
+        else:
+            offset = n
+        query = query[:-2]
+    return query, limit, offset
+
+
+
+#
+# Split the order by clause from the end of a select query.
+# select <qualifier> from <collection_list> [where <condition>] order by <attribute> [asc|desc][ , ...]
+# Return the query without it and the sort keys (None for no order by),
+# or None if the clause is invalid.
+#
+def get_order(query):
+    for i in range(4, len(query) - 1):
+        if query[i] == "order" and query[i + 1] == "by":
+            keys = get_order_keys(query[i + 2:])
+            if keys is None:
+                print("Invalid order by - attribute missing")
+                return None
+            return query[:i], keys
+    return query, None
+
+
+#
+# Wraps a sort key so that it sorts in descending order.
+# Used to mix ascending and descending keys in one sort key.
+#
+class Descending:
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+#
+# Get the function that makes the sort key of a resource for a list of (attribute path, descending) keys.
+# The keys are compared like Collection.sort(), see query.get_sort_key().
+# Return the function and whether it sorts in descending order.
+#
+def get_order_function(keys):
+    paths = [path for path, descending in keys]
+    descending = keys[0][1]
+    if len(keys) == 1:
+        path = paths[0]
+        return lambda resource: get_sort_key(get_path_value(resource.get_document(), path), descending), descending
+    if all(key[1] == descending for key in keys):
+        return lambda resource: tuple(get_sort_key(get_path_value(resource.get_document(), path), descending)
+                                      for path in paths), descending
+
+    def key(resource):
+        document = resource.get_document()
+        return tuple(Descending(get_sort_key(get_path_value(document, path), True)) if descending
+                     else get_sort_key(get_path_value(document, path), False) for path, descending in keys)
+    return key, False
+
+
+#
+# Generate the resource ids of a collection in the order of a range index, see index.RangeIndex.
+# Equal values are kept in collection order, as in a stable sort.
+# Values that are neither numbers nor strings are not in the sorted lists of the index,
+# they sort after strings (before them when descending) and null values sort with missing values.
+#
+def walk_range_index(collection, index, descending):
+    positions = collection.get_positions()
+
+    def by_position(ids):
+        return sorted(ids, key=positions.__getitem__)
+
+    def get_others():
+        others = [(get_path_value(collection.ids[id].get_document(), index.path), id)
+                  for id in by_position(id for id, value in index.keys.items() if value is None)]
+        json_values = sorted((entry for entry in others if entry[0] is not None),
+                             key=lambda entry: get_sort_key(entry[0], descending), reverse=descending)
+        return [id for value, id in json_values], [id for value, id in others if value is None]
+
+    if descending:
+        json_ids, null_ids = get_others()
+        yield from json_ids
+        sorted_lists = [reversed(index.strings), reversed(index.numbers)]
+    else:
+        sorted_lists = [index.numbers, index.strings]
+
+    for values in sorted_lists:
+        for value, group in groupby(values, key=itemgetter(0)):
+            yield from by_position(id for value, id in group)
+
+    if not descending:
+        json_ids, null_ids = get_others()
+        yield from json_ids
+    yield from by_position([id for id in collection.ids if id not in index.keys] + null_ids)
+
+
+#
+# Get the range index to walk for an order by, None to sort with a heap.
+# ids are the candidate resource ids of the where clause, None if the indexes do not narrow it.
+#
+def get_order_index(collection, keys, ids):
+    if len(keys) == 1 and ids is None:
+        return collection.get_index(keys[0][0], "range")
+    return None
+
+
+# Describe how an order by runs against a collection.
+def explain_order(collection, plan, keys):
+    ids, residual = (None, None) if plan is None else collection.read(plan.root.access)[1]
+    index = get_order_index(collection, keys, ids)
+    if index is not None:
+        return "walk " + str(index) + " until the limit"
+    if ids is None and residual is not None and scatter_accepts(collection):
+        return "bounded heap over the matches of a parallel scan"
+    count = len(collection.resources) if ids is None else len(ids)
+    return "bounded heap over " + str(count) + " resources"
+
+
+#
+# Get the resources of a collection that match a plan (None for every resource) in the order of the sort keys.
+# Only the first limit resources are kept (None for all), with a bounded heap, in O(n log limit).
+# The collection is not reordered.
+# When a single key has a range index and the where clause has no indexed candidates,
+# the index is walked in order and stops when limit resources are found.
+#
+def order_by(collection, plan, keys, limit):
+    snapshot, (ids, residual) = (collection.snapshot, (None, None)) if plan is None else \
+        collection.read(plan.root.access)
+    if get_order_index(snapshot, keys, ids) is not None:
+        # The walk reads the index as it goes, so it is a read of the indexes, see Collection.read().
+        def walk(snapshot):
+            index = get_order_index(snapshot, keys, ids)
+            resources = (snapshot.ids[id] for id in walk_range_index(snapshot, index, keys[0][1]))
+            if residual is not None:
+                resources = (resource for resource in resources if residual(resource.get_document()))
+            return list(islice(resources, limit))
+        return collection.read(walk)[1]
+
+    if ids is None and residual is not None and scatter_accepts(snapshot):
+        resources = scatter.pool.select(snapshot, plan)
+        residual = None
+    else:
+        resources = snapshot.resources if ids is None else snapshot.in_order(ids)
+    if residual is not None:
+        resources = (resource for resource in resources if residual(resource.get_document()))
+
+    key, descending = get_order_function(keys)
+    if limit is None:
+        return sorted(resources, key=key, reverse=descending)
+    if descending:
+        return heapq.nlargest(limit, resources, key=key)
+    return heapq.nsmallest(limit, resources, key=key)
+
+
+#
+# A Plan is a compiled where clause.
+# A plan has:
+#   - The where clause text, the tokens it was parsed from
+#   - The parsed tree of nodes
+#   - The compiled test of the whole clause
+#   - The number of times the plan has been used from the plan cache
+#
+class Plan:
+
+    def __init__(self, text, root):
+        self.text = text
+        self.root = root
+        self.test = root.compile()
+        self.hits = 0
+
+    def __str__(self):
+        return self.text
+
+    #
+    # Generate the resources of a collection that match the plan, in collection order.
+    # The indexes give the candidate resources, the compiled test checks what the indexes do not.
+    # Resources are tested as they are taken, so a caller that stops early stops the scan.
+    # limit is the most resources the caller will take, None if it takes them all.
+    #
+    def select(self, collection, limit=None):
+        snapshot, (ids, residual) = collection.read(self.root.access)
+        if ids is None and scatter_accepts(snapshot):
+            return iter(scatter.pool.select(snapshot, self, limit))
+        if ids is None:
+            resources = snapshot.resources
+        else:
+            resources = snapshot.in_order(ids, limit if residual is None else None)
+        if residual is None:
+            return iter(resources)
+        return (resource for resource in resources if residual(resource.get_document()))
+
+    # Count the resources of a collection that match the plan without building a result list.
+    def count(self, collection):
+        snapshot, (ids, residual) = collection.read(self.root.access)
+        if residual is None:
+            return len(ids)
+        if ids is None and scatter_accepts(snapshot):
+            return len(scatter.pool.select(snapshot, self))
+        # Order does not matter to a count.
+        resources = snapshot.resources if ids is None else (snapshot.ids[id] for id in ids)
+        return sum(1 for resource in resources if residual(resource.get_document()))
+
+    # Describe how the plan runs against a collection.
+    def explain(self, collection):
+        snapshot, (ids, residual) = collection.read(self.root.access)
+        if ids is None and scatter_accepts(snapshot):
+            access = "scan " + str(len(collection.resources)) + " resources in " + \
+                str(scatter.pool.count_partitions(collection)) + " parallel partitions"
+        elif ids is None:
+            access = "scan " + str(len(collection.resources)) + " resources"
+        elif residual is None:
+            access = str(len(ids)) + " resources from indexes"
+        else:
+            access = "test " + str(len(ids)) + " candidate resources from indexes"
+        lines = [collection.name + ": " + access]
+        lines += self.root.explain(snapshot, 1)
+        return lines
+
+
+#
+# The PlanCache keeps compiled plans keyed by their parsed where clause, see the __str__ of the nodes,
+# so a repeated query, or one that only differs in spacing or with between segments, is not compiled again.
+# The least recently used plan is dropped when the cache is full.
+#
+class PlanCache:
+
+    def __init__(self, size):
+        self.size = size
+        self.plans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return "Plan cache: " + str(len(self.plans)) + " of " + str(self.size) + " plans, " + \
+            str(self.hits) + " hits, " + str(self.misses) + " misses"
+
+    #
+    # Get the plan of a where clause.
+    # Return None if the where clause is invalid.
+    #
+    def get(self, tokens):
+        tokens = [token for token in tokens if token != ""]
+        try:
+            root = Parser(tokens).parse()
+        except QueryError as error:
+            print("Invalid where clause -", error)
+            return None
+        key = str(root)
+        plan = self.plans.get(key)
+        if plan is not None:
+            self.plans.move_to_end(key)
+            self.hits += 1
+            plan.hits += 1
+            return plan
+
+        plan = Plan(" ".join(tokens), root)
+        self.misses += 1
+        self.plans[key] = plan
+        if len(self.plans) > self.size:
+            self.plans.popitem(last=False)
+        return plan
+
+
+# The plan cache.
+cache = PlanCache(PLAN_CACHE_SIZE)
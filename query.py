@@ -7,46 +7,97 @@ import json
 
 #
 # Query functions for Collections and Resources.
+# Queries work against the parsed FHIR (json) document of a resource,
+# see Resource.get_document(), so a resource is only parsed once.
 #
 
+# Returned when an attribute path is not found in a document.
+MISSING = object()
+
+
+# Json is split into sequences or segments.
+# Find the specified segment in a document.
+# A segment that is a list resolves to its first entry.
+def get_segment(document, segment):
+    try:
+        part = document[segment]
+        while isinstance(part, list):
+            part = part[0]
+        return part
+    except (KeyError, TypeError, IndexError):
+        return None
+
+
+# Follow a path of segments to the attribute at the end of the path.
+# e.g. ["identifier", "value"]
+# Return the attribute value or MISSING.
+def get_path_value(document, path):
+    part = document
+    for segment in path[:-1]:
+        part = get_segment(part, segment)
+    try:
+        return part[path[-1]]
+    except (KeyError, TypeError, IndexError):
+        return MISSING
+
+
+# Get the key used to sort on an attribute value.
+# Numbers sort before strings (including dates) and strings before other json values.
+# Missing and null values sort last whether the order is ascending or descending.
+def get_sort_key(value, descending):
+    if value is MISSING or value is None:
+        return (not descending, 0, 0)
+    if isinstance(value, (bool, int, float)):
+        return (descending, 0, float(value))
+    if isinstance(value, str):
+        return (descending, 1, value)
+    return (descending, 2, json.dumps(value, sort_keys=True))
+
+
+# Get the (resource type, id) a FHIR reference refers to, the type is None when the reference does not name it.
+# e.g. Patient/123 and http://server/fhir/Patient/123/_history/2 -> ("Patient", "123"),
+# urn:uuid:a1b2 -> (None, "a1b2"), urn1 -> (None, "1") and 123 -> (None, "123")
+def get_reference(value):
+    reference = str(value)
+    if reference.startswith("urn:"):
+        return None, reference.rsplit(":", 1)[1]
+    if reference.startswith("urn"):
+        return None, reference[3:]
+    history = reference.find("/_history/")
+    if history != -1:
+        reference = reference[:history]
+    parts = reference.rsplit("/", 2)
+    if len(parts) >= 2:
+        return parts[-2], parts[-1]
+    return None, reference
+
+
 # Get a resource attribute value.
-def get_attribute_value(resource, attribute):
+def get_attribute_value(document, attribute):
     try:
-        j = json.loads(resource)
-        x = str(j[attribute]).replace("\'", "\"").replace("[", "").replace("]", "")
+        x = str(document[attribute]).replace("\'", "\"").replace("[", "").replace("]", "")
         return x
     except (KeyError, TypeError):
         return None
 
 
-# Json is split into sequences or segments.
 # Find the specified segments and return the attribute value.
-def get_segment_attribute_value(resource, segment, attribute):
-    try:
-        part = get_attribute_value(resource, segment)
-        result = get_attribute_value(part, attribute)
-        return result
-    except (KeyError, TypeError):
-        return None
+def get_segment_attribute_value(document, segment, attribute):
+    part = get_segment(document, segment)
+    return get_attribute_value(part, attribute)
 
 
 # Get an attribute value using segment1 and segment 2.
-def get_2segments_attribute_value(resource, segment1, segment2, attribute):
-    try:
-        part1 = get_attribute_value(resource, segment1)
-        part2 = get_attribute_value(part1, segment2)
-        result = get_attribute_value(part2, attribute)
-        return result
-    except (KeyError, TypeError):
-        return None
+def get_2segments_attribute_value(document, segment1, segment2, attribute):
+    part = get_segment(get_segment(document, segment1), segment2)
+    return get_attribute_value(part, attribute)
 
 
 # Test the value of an attribute using s subset of standard binary operators.
 # Determine if we comparing numbers of strings.
-def test_attribute_value(resource, attribute, operator, value):
+def test_attribute_value(document, attribute, operator, value):
     try:
-        j = json.loads(resource)
-        x = j[attribute]
+        x = document[attribute]
         y = value
         # TODO: Bug.
         if type(x) != str:
@@ -63,7 +114,7 @@ def test_attribute_value(resource, attribute, operator, value):
             return x >= y
         elif operator == "<":
             return x < y
-        elif operator <= y:
+        elif operator == "<=":
             return x <= y
         else:
             return None
@@ -72,34 +123,26 @@ def test_attribute_value(resource, attribute, operator, value):
 
 
 # Test a segment's attribute value.
-def test_segment_attribute_value(resource, segment, attribute, operator, value):
-    try:
-        part = get_attribute_value(resource, segment)
-        if part is None:
-            return None
-        result = test_attribute_value(part, attribute, operator, value)
-        return result
-    except (KeyError, TypeError):
+def test_segment_attribute_value(document, segment, attribute, operator, value):
+    part = get_segment(document, segment)
+    if part is None:
         return None
+    return test_attribute_value(part, attribute, operator, value)
 
 
 # Test 2 segment attribute value.
-def test_2segments_attribute_value(resource, segment1, segment2, attribute, operator, value):
-    try:
-        part1 = get_attribute_value(resource, segment1)
-        part2 = get_attribute_value(part1, segment2)
-        result = test_attribute_value(part2, attribute, operator, value)
-        return result
-    except (KeyError, TypeError):
+def test_2segments_attribute_value(document, segment1, segment2, attribute, operator, value):
+    part = get_segment(get_segment(document, segment1), segment2)
+    if part is None:
         return None
+    return test_attribute_value(part, attribute, operator, value)
 
 
 # Test range of an attribute.
-def test_attribute_range(resource, attribute, low, high):
+def test_attribute_range(document, attribute, low, high):
     # Test low and high are numbers
     try:
-        j = json.loads(resource)
-        x = j[attribute]
+        x = document[attribute]
         if low <= x <= high:
             return True
         else:
@@ -109,81 +152,39 @@ def test_attribute_range(resource, attribute, low, high):
 
 
 # Test the range of a segment.
-def test_segment_attribute_range(resource, segment, attribute, low, high):
-    try:
-        part = get_attribute_value(resource, segment)
-        result = test_attribute_range(part, attribute, low, high)
-        return result
-    except (KeyError, TypeError):
-        return None
+def test_segment_attribute_range(document, segment, attribute, low, high):
+    part = get_segment(document, segment)
+    return test_attribute_range(part, attribute, low, high)
 
 
 # Test the range of a segment(2) value within a segment(1).
-def test_2segments_attribute_range(resource, segment1, segment2, attribute, low, high):
-    try:
-        part1 = get_attribute_value(resource, segment1)
-        part2 = get_attribute_value(part1, segment2)
-        result = test_attribute_range(part2, attribute, low, high)
-        return result
-    except (KeyError, TypeError):
-        return None
+def test_2segments_attribute_range(document, segment1, segment2, attribute, low, high):
+    part = get_segment(get_segment(document, segment1), segment2)
+    return test_attribute_range(part, attribute, low, high)
 
 
 #
 # Collection Queries
+# A select where clause is compiled to a plan, see planner.py.
 #
-# Get all resources that have a segment where the attribute/operator/value expression is true.
-def get_resources_by_attribute_value(collection, attribute, operator, value, distinct):
-    result = list()
-    for resource in collection.resources:
-        if test_attribute_value(resource.data, attribute, operator, value):
-            result.append(resource)
-            if distinct:
-                return result
-    return result
-
-
-# Get all resources by attribute range
-def get_resources_by_attribute_range(collection, attribute, low, high, distinct):
-    result = list()
-    for resource in collection.resources:
-        if test_attribute_range(resource.data, attribute, low, high):
-            result.append(resource)
-            if distinct:
-                return result
-    return result
-
-
-# Get all resources that have a segment attribute where value operator value = True
-def get_resources_by_segment_attribute_value(collection, segment, attribute, operator, value):
-    result = list()
-    for resource in collection.resources:
-        if test_segment_attribute_value(resource.data, segment, attribute, operator, value):
-            result.append(resource)
-    return result
-
-
-def get_resources_by_2segments_attribute_value(collection, segment1, segment2, attribute, operator, value):
-    result = list()
-    for resource in collection.resources:
-        if test_2segments_attribute_value(resource.data, segment1, segment2, attribute, operator, value):
-            result.append(resource)
-    return result
-
-
-# Get all resources that have 2 segment attribute value range.
-def get_resources_by_segment_attribute_range(collection, segment, attribute, low, high):
-    result = list()
-    for resource in collection.resources:
-        if test_segment_attribute_range(resource.data, segment, attribute, low, high):
-            result.append(resource)
-    return result
-
-
-# Get all resources that have segment attribute value range.
-def get_resources_by_2segments_attribute_range(collection, segment1, segment2, attribute, low, high):
-    result = list()
-    for resource in collection.resources:
-        if test_2segments_attribute_range(resource.data, segment1, segment2, attribute, low, high):
-            result.append(resource)
-    return result
+# Get the index that answers an attribute/operator/value test on an attribute path.
+# A hash index answers = and !=, a range index or projected column answers any operator.
+# Return None when the collection has no suitable index on the path.
+def get_value_index(collection, path, operator):
+    index = None
+    if operator == "=" or operator == "!=":
+        index = collection.get_index(path, "hash")
+    if index is None:
+        index = collection.get_index(path, "range")
+    if index is None:
+        index = collection.get_index(path, "column")
+    return index
+
+
+# Get the range index or projected column that answers a range test on an attribute path.
+# Return None when the collection has neither on the path.
+def get_range_index(collection, path):
+    index = collection.get_index(path, "range")
+    if index is None:
+        index = collection.get_index(path, "column")
+    return index
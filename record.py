@@ -0,0 +1,221 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import json
+import struct
+import sys
+from array import array
+from itertools import islice, repeat
+
+# A binary record starts with this byte, a json text record never does.
+BINARY = 1
+
+# Value tags of a binary record.
+NULL = 0
+FALSE = 1
+TRUE = 2
+INTEGER = 3
+FLOAT = 4
+STRING = 5
+LIST = 6
+OBJECT = 7
+
+#
+# A binary record is a parsed FHIR (json) document written as tagged, typed arrays.
+# Header: BINARY, number of lists and objects, number of other values, number of attribute names,
+# number of integers, number of floats.
+# The header is followed by:
+#   - The tag of each list and object, in the order they end (children before their parent)
+#   - The tag of each other value (null, boolean, integer, float or string), in document order
+#   - The number of other values just before each list and object, the number of items in each,
+#     and the number of each attribute name in the collection's KeyTable, as 32 bit integers
+#   - The integers (64 bit) and floats (64 bit)
+#   - The strings in UTF-8, separated by NUL
+# Numbers are little endian. A document with an integer that does not fit in 64 bits, or a string
+# with a NUL, is kept as a json text record.
+#
+HEADER = struct.Struct("<BIIIII")
+
+
+#
+# A KeyTable numbers the attribute names of the binary records of a collection, so that a record
+# refers to each name by number and decoded documents share one copy of each name.
+# Names are only added, so a record can be read with any later table.
+# The table is saved with the collection's segment store, see SegmentStore.save_keys().
+#
+class KeyTable:
+
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.numbers = {name: number for number, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    # Get the number of a name, the name is added if it is new.
+    def get_number(self, name):
+        number = self.numbers.get(name)
+        if number is None:
+            number = self.numbers[name] = len(self.names)
+            self.names.append(name)
+        return number
+
+
+# Get the little endian bytes of an array.
+def to_bytes(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+# Read an array of a type from little endian bytes.
+def from_bytes(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+# Is a record (bytes) a binary record.
+def is_binary(record):
+    return len(record) > 0 and record[0] == BINARY
+
+
+#
+# Encode a parsed FHIR (json) document as a binary record.
+# Raises ValueError (or OverflowError) if the document cannot be a binary record.
+#
+def encode_document(document, keys):
+    kinds = bytearray()
+    tags = bytearray()
+    runs = array("I")
+    sizes = array("I")
+    names = array("I")
+    integers = array("q")
+    floats = array("d")
+    strings = list()
+    run = 0
+
+    def add(value):
+        nonlocal run
+        if isinstance(value, dict):
+            for item in value.values():
+                add(item)
+            names.extend(map(keys.get_number, value))
+            kinds.append(OBJECT)
+        elif isinstance(value, list):
+            for item in value:
+                add(item)
+            kinds.append(LIST)
+        else:
+            run += 1
+            if value is None:
+                tags.append(NULL)
+            elif value is True:
+                tags.append(TRUE)
+            elif value is False:
+                tags.append(FALSE)
+            elif isinstance(value, int):
+                tags.append(INTEGER)
+                integers.append(value)
+            elif isinstance(value, float):
+                tags.append(FLOAT)
+                floats.append(value)
+            elif "\0" in value:
+                raise ValueError("A string with a NUL")
+            else:
+                tags.append(STRING)
+                strings.append(value)
+            return
+        runs.append(run)
+        sizes.append(len(value))
+        run = 0
+
+    add(document)
+    return HEADER.pack(BINARY, len(kinds), len(tags), len(names), len(integers), len(floats)) + kinds + tags + \
+        to_bytes(runs + sizes + names) + to_bytes(integers) + to_bytes(floats) + "\0".join(strings).encode()
+
+
+#
+# Encode FHIR (json) text as a binary record of the parsed document, see HEADER.
+# Numbers, booleans and nulls keep their type, so they are not parsed again when the record is read.
+# Text that is not valid json, or cannot be a binary record, is kept as a text record.
+#
+def encode_record(data, keys):
+    try:
+        return encode_document(json.loads(data), keys)
+    except (ValueError, OverflowError):
+        return data.encode()
+
+
+#
+# Decode a binary record to the parsed FHIR (json) document.
+# The values are read with a few array calls, then each list and object is made from the values
+# before it, in the order they end.
+#
+def decode_binary(record, names):
+    marker, containers, values, keys, integers, floats = HEADER.unpack_from(record)
+    position = HEADER.size
+    kinds = record[position:position + containers]
+    position += containers
+    tags = record[position:position + values]
+    position += values
+    end = position + 4 * (2 * containers + keys)
+    numbers = from_bytes("I", record[position:end])
+    position, end = end, end + 8 * integers
+    integers = from_bytes("q", record[position:end])
+    position, end = end, end + 8 * floats
+    floats = from_bytes("d", record[position:end])
+    strings = bytes(record[end:]).decode().split("\0") if STRING in tags else ()
+
+    sources = [repeat(None), repeat(False), repeat(True), iter(integers), iter(floats), iter(strings)]
+    values = map(next, map(sources.__getitem__, tags))
+    keys = map(names.__getitem__, numbers[2 * containers:])
+    stack = list()
+    extend = stack.extend
+    append = stack.append
+    for kind, run, size in zip(kinds, numbers[:containers], numbers[containers:2 * containers]):
+        if run:
+            extend(islice(values, run))
+        if size:
+            items = stack[-size:]
+            del stack[-size:]
+        else:
+            items = list()
+        append(dict(zip(islice(keys, size), items)) if kind == OBJECT else items)
+    extend(values)
+    if len(stack) != 1:
+        raise ValueError("Invalid binary record")
+    return stack[0]
+
+
+#
+# Decode a record to the parsed FHIR (json) document.
+# A record can be FHIR (json) text, or bytes of a binary or text record.
+# names is the list of attribute names of the collection's KeyTable, for a binary record.
+# Raises ValueError (or TypeError) if the record is not valid.
+#
+def decode_document(record, names=None):
+    if is_binary(record):
+        try:
+            return decode_binary(record, names)
+        except (struct.error, IndexError, StopIteration):
+            raise ValueError("Invalid binary record")
+    return json.loads(record)
+
+
+# Get the FHIR (json) text of a record.
+def get_text(record, names=None):
+    if isinstance(record, str):
+        return record
+    if is_binary(record):
+        return to_json(decode_document(record, names))
+    return bytes(record).decode()
+
+
+# Get the canonical FHIR (json) text of a document, without whitespace.
+def to_json(document):
+    return json.dumps(document, separators=(",", ":"), ensure_ascii=False)
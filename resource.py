@@ -6,8 +6,12 @@ Author: Tim Hastings, 2023
 import os.path
 import uuid
 
-from query import get_attribute_value, get_segment_attribute_value
+from record import decode_document, get_text, to_json
+from query import get_attribute_value, get_segment_attribute_value, test_attribute_value, \
+    test_segment_attribute_value
 from schema import Schema
+from storage import get_store, save_resources
+import buffer_pool
 import json
 
 # Return the length of resource data
@@ -16,6 +20,32 @@ length = 0
 # Remove whitespace reduces up to 28%
 compress = 1
 
+
+#
+# Remove unnecessary whitespace from FHIR (json) text.
+# The text is parsed and written again without whitespace, so string values are not changed.
+#
+def compress_data(data):
+    if not compress:
+        return data.replace('\n', '')
+    try:
+        return to_json(json.loads(data))
+    except ValueError:
+        # Text that is not valid json only has its line breaks removed.
+        return data.replace('\n', '')
+
+
+#
+# Read a resource file, return None if it cannot be found.
+#
+def read_file(path):
+    try:
+        with open(path, 'r') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
 #
 # A Resource is a collection item in the Collection resources list.
 #
@@ -26,6 +56,145 @@ class Resource:
         self.data = ""
         self.state = Schema.LOADED
 
+    # The FHIR (json) text of the resource.
+    # Data that is not in memory is read from storage when it is used, see buffer_pool.py.
+    # Without a buffer pool, memory mapped data is decoded on every use.
+    # A resource loaded from a segment store keeps its binary record and makes the text on first use.
+    # Changing the data drops the parsed document, the record and any mapping.
+    @property
+    def data(self):
+        data = self._data
+        if data is not None:
+            if buffer_pool.pool is not None:
+                buffer_pool.pool.hit(self)
+            return data
+        record = self._record
+        if record is None:
+            data = get_text(self.read(), self.get_keys())
+            if buffer_pool.pool is not None:
+                # Another thread may evict the resource once it is in the pool.
+                self._data = data
+                buffer_pool.pool.add(self, len(data))
+            return data
+        original = self._original
+        data = original.data if self.shares_body(original) else get_text(record, self.get_keys())
+        self._data = data
+        if buffer_pool.pool is not None:
+            # The record and the data made from it are both kept.
+            buffer_pool.pool.hit(self)
+            buffer_pool.pool.grow(self, len(data))
+        return data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._document = None
+        self._record = None
+        self._original = None
+        self.location = None
+        if buffer_pool.pool is not None:
+            buffer_pool.pool.remove(self)
+
+    # Is the FHIR (json) text of the resource in memory, so getting data does not decode or read it.
+    def has_text(self):
+        return self._data is not None
+
+    # Set the resource to a record read from a segment store, see record.py.
+    def set_record(self, record):
+        self.data = None
+        self._record = record
+
+    # Get the data or record of the resource when it is kept in memory, otherwise None.
+    def get_body(self):
+        if buffer_pool.pool is not None or self.location is not None:
+            return None
+        return self._record if self._record is not None else self._data
+
+    # Share the data of a resource with the same body, see Collection.share().
+    # The document is parsed once, by the resource that is shared.
+    # A resource can be in more than one collection, so the shared resource is the first that shares no other.
+    def share(self, resource):
+        while resource.shares_body(resource._original):
+            resource = resource._original
+        if resource is self:
+            return
+        self._data = resource._data
+        self._record = resource._record
+        self._document = resource._document
+        self._original = resource
+
+    # Does the resource still have the body of the resource it shares, whose data could have changed.
+    def shares_body(self, original):
+        if original is None:
+            return False
+        if self._record is not None:
+            return original._record is self._record
+        return original._data is self._data
+
+    # Map the resource to its data in a memory mapped segment store.
+    # location is (store, segment, offset, length), see SegmentStore.read_at()
+    def set_location(self, location):
+        self.unload()
+        self.location = location
+
+    # Drop the data, record and parsed document, they are read from storage when next used.
+    def unload(self):
+        self._data = None
+        self._document = None
+        self._record = None
+        self._original = None
+
+    # Get the attribute names of the binary records of the resource's collection, see record.KeyTable.
+    def get_keys(self):
+        store = get_store(self.type)
+        return store.keys.names if store is not None else None
+
+    # Read the data of a saved resource from storage.
+    # Return the record bytes from a segment store, or the FHIR (json) text of a resource file
+    # when the resource is not in a store.
+    def read(self):
+        location = self.location
+        if location is not None:
+            return location[0].read_at(*location[1:])
+        store = get_store(self.type)
+        if store is not None and str(self.uuid) in store.offsets:
+            return store.read(str(self.uuid))
+        data = read_file(os.path.join(Schema.ROOT, self.type, str(self.uuid)))
+        if data is None:
+            print("Resource: Load Error")
+            return ""
+        return compress_data(data)
+
+    # Get the parsed FHIR (json) document.
+    # The document is parsed on first use and kept until the data changes.
+    # A binary record is decoded straight to the document, without making the text.
+    # A use of a document or record kept in the buffer pool is a hit, so it is evicted last.
+    def get_document(self):
+        document = self._document
+        if buffer_pool.pool is not None and (document is not None or self._record is not None):
+            buffer_pool.pool.hit(self)
+        original = self._original
+        if document is None and self.shares_body(original):
+            document = self._document = original.get_document()
+        if document is None:
+            record = self._data
+            if record is None:
+                record = self._record
+            if record is None:
+                record = self.read()
+                if buffer_pool.pool is not None:
+                    self._record = record
+                    buffer_pool.pool.add(self, len(record))
+            try:
+                document = decode_document(record, self.get_keys())
+            except (TypeError, ValueError):
+                # Invalid json has no attributes.
+                document = dict()
+            self._document = document
+            if buffer_pool.pool is not None:
+                buffer_pool.pool.add_document(self)
+        return document
+
     def __str__(self):
         if length:
             return str(len(self.data)) + ', ' + str(self.uuid) + ', ' + self.type + ', ' + self.data
@@ -34,12 +203,19 @@ class Resource:
 
     # Find the attribute value in the FHIR (json).
     def get_attribute_value(self, attribute):
-        att = get_attribute_value(self.data, attribute)
-        return att
+        return get_attribute_value(self.get_document(), attribute)
 
     # Find the attribute in the first segment of FHIR (json).
     def get_segment_attribute_value(self, segment, attribute):
-        att = get_segment_attribute_value(self.data, segment, attribute)
+        return get_segment_attribute_value(self.get_document(), segment, attribute)
+
+    # Test an attribute value.
+    def test_attribute_value(self, attribute, operator, value):
+        return test_attribute_value(self.get_document(), attribute, operator, value)
+
+    # Test a segment attribute value.
+    def test_segment_attribute_value(self, segment, attribute, value):
+        return test_segment_attribute_value(self.get_document(), segment, attribute, "=", value)
 
     # Load a resource from a file.
     def load_file(self, file_name, collection):
@@ -51,69 +227,6 @@ class Resource:
         except FileNotFoundError:
             return False
 
-    # Get an attribute's value.
-    def get_attribute_value(self, attribute):
-        try:
-            j = json.loads(self.data)
-            x = str(j[attribute]).replace("\'", "\"").replace("[", "").replace("]", "")
-            return x
-        except KeyError:
-            return None
-
-    # Get a segment attribute value.
-    def get_segment_attribute_value(self, segment, attribute):
-        try:
-            part = self.get_attribute_value(segment)
-            t = Resource("Segment")
-            t.data = part
-            result = t.get_attribute_value(attribute)
-            return result
-        except KeyError:
-            return None
-
-    # Test and attribute value.
-    def test_attribute_value(self, attribute, operator, value):
-        try:
-            j = json.loads(self.data)
-            x = j[attribute]
-            y = value
-            # If the attribute is a number then make y a number.
-            if type(x) != str:
-                if value.isnumeric():
-                    y = float(value)
-
-            if operator == "=":
-                return x == y
-            if operator == "!=":
-                return x != y
-            elif operator == ">":
-                return x > y
-            elif operator == ">=":
-                return x >= y
-            elif operator == "<":
-                return x < y
-            elif operator <= y:
-                return x <= y
-            else:
-                return None
-
-        except KeyError:
-            return None
-
-    # Test a segment attribute value.
-    def test_segment_attribute_value(self, segment, attribute, value):
-        try:
-            part = self.get_attribute_value(segment)
-            t = Resource("Segment")
-            t.data = part
-            result = t.get_attribute_value(attribute)
-            if result == value:
-                return True
-            else:
-                return False
-        except KeyError:
-            return None
-
     # Find a string in a resource.
     def search(self, qry):
         if self.data.find(qry) == -1:
@@ -129,19 +242,7 @@ class Resource:
 
             with open(path, 'r') as file:
                 self.uuid = file_name
-                if not compress:
-                    self.data = file.read().replace('\n', '')
-                else:
-                    # Remove unnecessary whitespace.
-                    # Compress the size of FHIR Patient by up to 28%
-                    self.data = file.read().replace('\n', '') \
-                        .replace('  ', ' ').replace('  ', ' ').replace('  ', ' ').replace('  ', ' ') \
-                        .replace(' : ', ':') \
-                        .replace('{ ', '{') \
-                        .replace('} ', '}') \
-                        .replace('" }', '"}') \
-                        .replace('] }', ']}') \
-                        .replace(', ', ',').replace(', ', ',')
+                self.data = compress_data(file.read())
                 self.state = Schema.LOADED
 
         except FileNotFoundError:
@@ -150,19 +251,32 @@ class Resource:
             self.state = Schema.LOAD_ERROR
             print("Resource: Load Error")
 
+    # Get a new version of the resource with new data.
+    # An update replaces a resource with its new version, so readers of a collection snapshot
+    # keep the version they started with, see collection.Snapshot.
+    def new_version(self, data):
+        resource = Resource(self.type)
+        resource.uuid = self.uuid
+        resource.data = data
+        return resource
+
+    # Share the data and parsed document of another resource.
+    def copy_data(self, resource):
+        self.data = resource.data
+        self._document = resource.get_document()
+
     # Save a resource to storage.
     def save(self):
+        # Remove unnecessary whitespace before the resource is written.
+        # Data without whitespace is kept, so a shared body stays shared.
+        data = self.data
+        compressed = compress_data(data)
+        if compressed != data:
+            self.data = compressed
         try:
-            t = os.path.join(Schema.ROOT, self.type)
-            path = os.path.join(t, str(self.uuid))
-            f = open(path, "w")
-            f.write(self.data)
-            f.close()
-            self.state = Schema.SAVED
-            # Bug: Reload the resource so white space is removed.
-            fn = str(self.uuid)
-            self.data = ""
-            self.load(fn)
-        except FileExistsError:
+            save_resources(self.type, [self])
+            if buffer_pool.pool is not None:
+                buffer_pool.pool.add(self, len(self.data), miss=False)
+        except OSError:
             self.state = Schema.SAVE_ERROR
-            print("Resource: Save Error")
\ No newline at end of file
+            print("Resource: Save Error")
@@ -0,0 +1,221 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import time
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, wait
+from itertools import islice
+
+import planner
+import schema
+from record import decode_document
+from storage import get_store, SegmentStore
+
+# Fewest resources in a partition. A collection too small for two partitions is scanned in the
+# main process, where the scan does not wait for messages to and from the workers, unless it is
+# scanned at the same time as other collections, see Schema.map_collections().
+PARTITION_SIZE = 5000
+
+# The segment stores of a worker process by collection name, used to read memory mapped segments.
+# Each store is kept with the sorted locations of its resources and the resource ids at each location.
+worker_stores = dict()
+
+
+#
+# Get the segment store of a collection in a worker process, with its sorted locations and the ids
+# at each location. The store is opened again when its segment sizes are not sizes (None for any),
+# so the worker sees appends, updates and compactions made by the main process.
+#
+def open_worker_store(name, sizes=None):
+    entry = worker_stores.get(name)
+    if entry is not None and (sizes is None or entry[0].sizes == sizes):
+        return entry
+    store = entry[0] if entry is not None else SegmentStore(name)
+    store.unmap()
+    store.mapped = True
+    store.open()
+    ids = dict()
+    for id, location in store.offsets.items():
+        ids.setdefault(location, list()).append(id)
+    entry = worker_stores[name] = (store, sorted(ids), ids)
+    return entry
+
+
+# Open the segment stores of collections when a worker process starts, see ScatterPool.
+def warm_worker(names):
+    for name in names:
+        try:
+            open_worker_store(name)
+        except OSError:
+            pass
+
+
+#
+# Scan a partition of a collection in a worker process.
+# The worker reads each resource from the memory mapped segments of the collection's store,
+# so resource data is shared through the page cache and not sent to the worker.
+# The where clause is compiled in the worker and kept in the worker's plan cache.
+# ranges is the partition, a list of (segment, start, end) byte ranges, and sizes the segment sizes
+# of the main process's store, see open_worker_store().
+# Resources that share a body are tested once.
+# Return the ids of the matching resources in storage order, the number of bodies scanned and the
+# scan time in ms. The scan stops after limit matches (None for no limit).
+#
+def scan_partition(name, text, ranges, sizes, limit):
+    start = time.perf_counter()
+    store, locations, ids = open_worker_store(name, sizes)
+
+    test = planner.cache.get(text.split(" ")).test
+    matches = list()
+    scanned = 0
+    for segment, low, high in ranges:
+        first = bisect_left(locations, (segment, low))
+        last = bisect_left(locations, (segment, high))
+        for location in islice(locations, first, last):
+            scanned += 1
+            try:
+                document = decode_document(store.read_at(*location), store.keys.names)
+            except (TypeError, ValueError):
+                document = {}
+            if test(document):
+                matches.extend(ids[location])
+                if limit is not None and len(matches) >= limit:
+                    return matches, scanned, (time.perf_counter() - start) * 10 ** 3
+    return matches, scanned, (time.perf_counter() - start) * 10 ** 3
+
+
+#
+# Split the segments of a store into n partitions of about the same number of bytes.
+# sizes is the size of each segment. A partition is a list of (segment, start, end) byte ranges.
+#
+def get_partitions(sizes, n):
+    share = max(1, -(-sum(sizes.values()) // n))
+    partitions = [list()]
+    used = 0
+    for segment in sorted(sizes):
+        start = 0
+        while start < sizes[segment]:
+            end = min(sizes[segment], start + share - used)
+            partitions[-1].append((segment, start, end))
+            used += end - start
+            start = end
+            if used == share and len(partitions) < n:
+                partitions.append(list())
+                used = 0
+    return [ranges for ranges in partitions if ranges]
+
+
+# Get the names of the packed collections of a schema.
+def get_packed(schema):
+    return [collection.name for collection in schema.collections if get_store(collection.name) is not None]
+
+
+# Is the current thread scanning one of several collections at once, see Schema.map_collections().
+def is_concurrent():
+    return getattr(schema.concurrent_scans, "active", False)
+
+
+#
+# A ScatterPool scans packed collections in parallel.
+# The segments of a collection's store are split into one partition of contiguous byte ranges per
+# worker, so only the bounds of each partition are sent to a worker. The workers keep the stores
+# open between scans, and open the stores of the collections they are given when the pool starts.
+# The matches are gathered and put in collection order.
+# A record is stored before its resource is published, so a scan that overlaps a write to the
+# collection tests the stored version of each resource.
+# A pool has:
+#   - The number of worker processes and the process pool
+#   - The (records scanned, matches, ms) of each partition of the last scan of each collection
+#   - For each collection, whether the resources of its latest scanned snapshot are in storage order
+#
+class ScatterPool:
+
+    def __init__(self, workers, names=()):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=warm_worker, initargs=(list(names),))
+        self.partitions = dict()
+        self.ordered = dict()
+        # Start the workers now, so the first scan does not wait for them to start and open their stores.
+        wait([self.executor.submit(int) for i in range(workers)])
+
+    def __str__(self):
+        return "Parallel scans: " + str(self.workers) + " workers"
+
+    # Stop the worker processes.
+    def shutdown(self):
+        self.executor.shutdown()
+
+    # Get the number of partitions a collection is scanned in.
+    def count_partitions(self, collection):
+        partitions = min(self.workers, len(collection.resources) // PARTITION_SIZE)
+        if is_concurrent() and len(collection.resources) > 0:
+            return max(1, partitions)
+        return partitions
+
+    #
+    # A collection is scanned in parallel when it is packed and has enough resources for two partitions,
+    # or has any resources when it is scanned at the same time as other collections.
+    #
+    def accepts(self, collection):
+        return self.count_partitions(collection) > (0 if is_concurrent() else 1) and \
+            get_store(collection.name) is not None
+
+    #
+    # Are the resources of a collection in storage order, so a partition's first matches are also
+    # its first in collection order. Checked once for each snapshot of the collection.
+    #
+    def is_ordered(self, collection, store):
+        resources = collection.resources
+        entry = self.ordered.get(collection.name)
+        if entry is not None and entry[0] is resources:
+            return entry[1]
+        ordered = True
+        previous = ()
+        for resource in resources:
+            location = store.offsets.get(str(resource.uuid))
+            if location is None or location < previous:
+                ordered = False
+                break
+            previous = location
+        self.ordered[collection.name] = (resources, ordered)
+        return ordered
+
+    #
+    # Get the resources of a collection that match a plan, in collection order.
+    # Only the first limit matches are returned (None for all). The workers stop after limit
+    # matches when the collection is in storage order.
+    # Resources stored after the snapshot are not in it and are dropped. A partition that stopped
+    # early with fewer than limit matches left is scanned again without stopping, since the dropped
+    # matches took the place of matches in the snapshot.
+    #
+    def select(self, collection, plan, limit=None):
+        store = get_store(collection.name)
+        sizes = dict(store.sizes)
+        first = limit if limit is not None and self.is_ordered(collection, store) else None
+        partitions = get_partitions(sizes, self.count_partitions(collection))
+        futures = [self.executor.submit(scan_partition, collection.name, plan.text, ranges, sizes, first)
+                   for ranges in partitions]
+
+        resources = collection.ids
+        results = [future.result() for future in futures]
+        rescans = dict()
+        for i, (matches, scanned, ms) in enumerate(results):
+            if first is not None and len(matches) >= first and sum(1 for id in matches if id in resources) < first:
+                rescans[i] = self.executor.submit(scan_partition, collection.name, plan.text, partitions[i],
+                                                  sizes, None)
+        timings = list()
+        ids = set()
+        for i, (matches, scanned, ms) in enumerate(results):
+            if i in rescans:
+                matches, rescanned, rescan_ms = rescans[i].result()
+                scanned += rescanned
+                ms += rescan_ms
+            timings.append((scanned, len(matches), ms))
+            ids.update(id for id in matches if id in resources)
+        self.partitions[collection.name] = timings
+        return collection.in_order(ids, limit)
+
+
+# The scatter pool, None when scans run in the main process.
+pool = None
@@ -0,0 +1,44 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import scatter
+
+
+#
+# Parallel command.
+# Scan packed collections with n worker processes, see scatter.py.
+# parallel <n>
+# parallel off
+#
+def set_parallel(schema, command_line):
+    if len(command_line) < 2:
+        print("Invalid parallel command - number of workers missing")
+        return
+
+    workers = 0
+    if command_line[1] != "off":
+        try:
+            workers = int(command_line[1])
+        except ValueError:
+            print("Invalid parallel command - workers must be a number or off")
+            return
+
+    if scatter.pool is not None:
+        scatter.pool.shutdown()
+        scatter.pool = None
+    if workers > 1:
+        scatter.pool = scatter.ScatterPool(workers, scatter.get_packed(schema))
+        print(scatter.pool)
+    else:
+        print("Parallel scans off")
+
+
+#
+# Print the time taken by each partition of the last parallel scan of a collection.
+#
+def print_partitions(collection_name):
+    if scatter.pool is None:
+        return
+    for i, (scanned, matches, ms) in enumerate(scatter.pool.partitions.pop(collection_name, ()), 1):
+        print(f"Partition {i}: {scanned} records, {matches} matches in {ms:.02f} ms")
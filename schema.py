@@ -3,7 +3,13 @@ FHIR Server Proof of Concept
 Author: Tim Hastings, 2023
 """
 import os
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Set in the threads of Schema.map_collections() that scan one of several collections at once, see scatter.py.
+concurrent_scans = threading.local()
 
 #
 # A schema defines the database schema.
@@ -31,6 +37,7 @@ class Schema:
         self.author = "Tim Hastings (C), 2023"
         self.collections = list()
         self.number_of_results = 10
+        self.executor = None
         self.state = Schema.LOADED
 
     def __str_(self):
@@ -49,9 +56,42 @@ class Schema:
         dir_list = os.listdir(path)
         return dir_list
 
+    # Save the collection indexes that have changed.
+    def save_indexes(self):
+        for collection in self.collections:
+            collection.save_indexes()
+
+    #
+    # Run a function on each collection in a list, concurrently on a thread pool when there are several.
+    # Scans that wait on storage or on the parallel scan worker processes (see scatter.py) overlap.
+    # While the scatter pool is running a packed collection is scanned by the worker processes however
+    # small it is, so the scans of the collections run in parallel and not in turn under the interpreter lock.
+    # Return the results in collection list order and the (collection name, ms) taken by each collection.
+    #
+    def map_collections(self, function, collections):
+        concurrent = len(collections) > 1
+
+        def timed(collection):
+            concurrent_scans.active = concurrent
+            start = datetime.now()
+            result = function(collection)
+            return result, (datetime.now() - start).total_seconds() * 10 ** 3
+
+        if concurrent:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor()
+            timed_results = list(self.executor.map(timed, collections))
+        else:
+            timed_results = [timed(collection) for collection in collections]
+        timings = [(collection.name, ms) for collection, (result, ms) in zip(collections, timed_results)]
+        return [result for result, ms in timed_results], timings
+
     # Search a list of collections with a query list.
+    # Return the results and the (collection name, ms) taken by each collection.
     def search(self, collectionList, query_list):
         results = list()
-        for collection in collectionList:
-            results += collection.search_complex(query_list)
-        return results
\ No newline at end of file
+        all_results, timings = self.map_collections(lambda collection: collection.search_complex(query_list),
+                                                    collectionList)
+        for result in all_results:
+            results += result
+        return results, timings
\ No newline at end of file
@@ -0,0 +1,36 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+
+
+#
+# Search command.
+# Find the resources that contain every text, see Collection.search_complex().
+# search <qualifier> from <collection_list> for <text> [<text> ...]
+# Return the result list of resources and the (collection name, ms) taken by each collection,
+# or None if the command is invalid.
+#
+def search_collections(schema, command_line):
+    if len(command_line) < 6:
+        print("Invalid search command - too few arguments")
+        return None
+
+    if command_line[2] != "from":
+        print("Invalid search command - use the from keyword")
+        return None
+
+    if command_line[4] != "for":
+        print("Invalid search command - use the for keyword")
+        return None
+
+    collections = list()
+    for collection_name in command_line[3].split(","):
+        collection = schema.get_collection(collection_name)
+        if collection is None:
+            print("Invalid Collection")
+            return None
+        collections.append(collection)
+
+    query_set = [text for text in command_line[5:] if text != ""]
+    return schema.search(collections, query_set)
@@ -0,0 +1,399 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import asyncio
+import json
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import planner
+from resource import Resource
+from storage import delete_resources, get_store
+import buffer_pool
+
+# Seconds a keep-alive connection waits for its next request.
+IDLE_TIMEOUT = 15
+
+# Largest request body accepted.
+MAX_BODY = 16 * 1024 * 1024
+
+# Resources returned by a search when _count is not given, and the most that _count may ask for.
+SEARCH_COUNT = 50
+MAX_SEARCH_COUNT = 1000
+
+# Most index entries read, or resources returned, by a search that runs on the event loop.
+INDEXED_COST = 1000
+
+# Latencies kept for each route, used for the percentiles.
+LATENCY_SAMPLES = 1000
+
+# A FHIR logical id.
+FHIR_ID = re.compile(r"^[A-Za-z0-9\-.]{1,64}$")
+
+# FHIR search prefixes of number and date parameters, e.g. birthDate=ge1975-01-01
+PREFIXES = {"eq": "=", "ne": "!=", "gt": ">", "ge": ">=", "lt": "<", "le": "<="}
+
+REASONS = {200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+CONTENT_TYPE = "application/fhir+json"
+
+
+#
+# An HTTP error returned to the client as an OperationOutcome.
+#
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+    def to_json(self):
+        return json.dumps({"resourceType": "OperationOutcome",
+                           "issue": [{"severity": "error", "code": "processing", "diagnostics": self.message}]})
+
+
+#
+# Request latency metrics.
+# Metrics has for each route (e.g. GET read):
+#   - The number of requests and their total time
+#   - The latest LATENCY_SAMPLES latencies in ms, for the median and 99th percentile
+#
+class Metrics:
+
+    def __init__(self):
+        self.routes = dict()
+        self.connections = 0
+
+    # Record the latency of a request.
+    def add(self, route, ms):
+        entry = self.routes.get(route)
+        if entry is None:
+            entry = self.routes[route] = [0, 0.0, 0.0, deque(maxlen=LATENCY_SAMPLES)]
+        entry[0] += 1
+        entry[1] += ms
+        entry[2] = max(entry[2], ms)
+        entry[3].append(ms)
+
+    def to_json(self):
+        routes = dict()
+        for route, (count, total, longest, samples) in sorted(self.routes.items()):
+            ordered = sorted(samples)
+            routes[route] = {"count": count, "mean_ms": round(total / count, 3),
+                             "p50_ms": round(ordered[len(ordered) // 2], 3),
+                             "p99_ms": round(ordered[min(len(ordered) - 1, len(ordered) * 99 // 100)], 3),
+                             "max_ms": round(longest, 3)}
+        return {"connections": self.connections, "routes": routes}
+
+    def __str__(self):
+        lines = list()
+        for route, entry in self.to_json()["routes"].items():
+            lines.append(f"{route}: {entry['count']} requests, mean {entry['mean_ms']} ms, "
+                         f"p50 {entry['p50_ms']} ms, p99 {entry['p99_ms']} ms, max {entry['max_ms']} ms")
+        return "\n".join(lines)
+
+
+#
+# An asyncio HTTP server for the FHIR REST API of a schema.
+#   GET /<collection>/<id>             read a resource by uuid or FHIR id
+#   GET /<collection>?<param>=<value>  search, e.g. /Patient?gender=male&birthDate=ge1975&_count=10
+#   POST /<collection>                 create a resource
+#   PUT /<collection>/<id>             update a resource
+#   DELETE /<collection>/<id>          delete a resource
+#   GET /_metrics                      request latency metrics
+# Requests that indexes answer from a few entries, with resources kept in memory, run on the event loop.
+# Scans, large index results, reads from storage and the text made from binary records run on a thread pool
+# so that slow searches and cold reads do not hold up other requests, and writes run one at a time on a
+# writer thread.
+# Connections are kept alive until the client closes them or they are idle for IDLE_TIMEOUT seconds.
+#
+class FhirServer:
+
+    def __init__(self, schema, workers=None):
+        self.schema = schema
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.metrics = Metrics()
+
+    # Get a collection by name, the Result collection of the command line is not served.
+    def get_collection(self, name):
+        collection = self.schema.get_collection(name)
+        if collection is None or collection.name == "Result":
+            raise HttpError(404, "Unknown collection " + name)
+        return collection
+
+    # Run a function on the thread pool, or on the event loop when it is answered by indexes.
+    async def run(self, function, *args, indexed=False):
+        if indexed:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    # Get a compiled where clause from the plan cache.
+    def get_plan(self, tokens):
+        plan = planner.cache.get(tokens)
+        if plan is None:
+            raise HttpError(400, "Invalid search " + " ".join(tokens))
+        return plan
+
+    # Are the resources of a collection kept in memory, so returning them does no I/O.
+    def in_memory(self, collection):
+        store = get_store(collection.name)
+        return buffer_pool.pool is None and (store is None or not store.mapped)
+
+    # Is a plan answered by the indexes of a collection from at most INDEXED_COST entries,
+    # without testing any resource or reading from storage.
+    # The decision is made from the plan's nodes and the sizes of the indexes, no ids are found.
+    def is_indexed(self, collection, plan):
+        if not self.in_memory(collection):
+            return False
+        snapshot, cost = collection.read(plan.root.get_cost)
+        return cost is not None and cost <= INDEXED_COST
+
+    #
+    # Find a resource by uuid or FHIR id.
+    # Return the first resource in collection order with the FHIR id, None if there is none.
+    #
+    async def find(self, collection, id):
+        resource = collection.get(id)
+        if resource:
+            return resource
+        if not FHIR_ID.match(id):
+            return None
+        plan = self.get_plan(["id", "=", id])
+        return await self.run(lambda: next(plan.select(collection, 1), None),
+                              indexed=self.is_indexed(collection, plan))
+
+    # Read a resource, its text is made from its record or read from storage on the thread pool.
+    async def read(self, collection, id):
+        resource = await self.find(collection, id)
+        if resource is None:
+            raise HttpError(404, collection.name + "/" + id + " not found")
+        data = await self.run(lambda: resource.data, indexed=resource.has_text())
+        return 200, data, ()
+
+    #
+    # Search a collection, each parameter is a condition and the conditions are combined with and.
+    # A parameter is an attribute path with . between segments, e.g. subject.reference=urn1
+    # _count is the number of resources returned and _offset the number skipped.
+    #
+    async def search(self, collection, query):
+        count = SEARCH_COUNT
+        offset = 0
+        tokens = list()
+        for name, value in parse_qsl(query, keep_blank_values=True):
+            try:
+                if name == "_count":
+                    count = max(0, min(int(value), MAX_SEARCH_COUNT))
+                    continue
+                if name == "_offset":
+                    offset = max(0, int(value))
+                    continue
+            except ValueError:
+                raise HttpError(400, name + " must be a number")
+            if " " in name or " " in value or value == "":
+                raise HttpError(400, "Invalid search parameter " + name)
+            operator = "="
+            if value[:2] in PREFIXES and value[2:3].isdigit():
+                operator = PREFIXES[value[:2]]
+                value = value[2:]
+            if tokens:
+                tokens.append("and")
+            tokens += name.split(".") + [operator, value]
+
+        if tokens:
+            plan = self.get_plan(tokens)
+            indexed = self.is_indexed(collection, plan)
+        else:
+            plan = None
+            indexed = self.in_memory(collection) and offset + count <= INDEXED_COST
+
+        def select():
+            results = iter(collection.resources) if plan is None else plan.select(collection, offset + count)
+            return [(resource.uuid, resource.data) for resource in islice(results, offset, offset + count)]
+
+        entries = await self.run(select, indexed=indexed)
+        body = '{"resourceType":"Bundle","type":"searchset","entry":[' + \
+            ",".join('{"fullUrl":"' + collection.name + "/" + str(id) + '","resource":' + data + "}"
+                     for id, data in entries) + "]}"
+        return 200, body, ()
+
+    # Check a request body is a FHIR (json) resource.
+    def get_data(self, body):
+        try:
+            document = json.loads(body)
+        except ValueError:
+            raise HttpError(400, "Invalid json")
+        if not isinstance(document, dict):
+            raise HttpError(400, "A resource must be a json object")
+        return body.decode("utf-8")
+
+    # Create a resource, the new resource's uuid is returned in the Location header.
+    async def create(self, collection, body):
+        data = self.get_data(body)
+
+        def write():
+            resource = Resource(collection.name)
+            resource.type = collection.name
+            resource.data = data
+            resource.save()
+            collection.add_resource(resource)
+            collection.save_indexes()
+            return resource
+
+        resource = await asyncio.get_running_loop().run_in_executor(self.writer, write)
+        return 201, resource.data, (("Location", "/" + collection.name + "/" + str(resource.uuid)),)
+
+    # Update a resource.
+    async def update(self, collection, id, body):
+        data = self.get_data(body)
+        resource = await self.find(collection, id)
+        if resource is None:
+            raise HttpError(404, collection.name + "/" + id + " not found")
+
+        def write():
+            updated = resource.new_version(data)
+            updated.save()
+            collection.update_resource(updated.uuid, updated)
+            collection.save_indexes()
+            return updated
+
+        updated = await asyncio.get_running_loop().run_in_executor(self.writer, write)
+        return 200, updated.data, ()
+
+    # Delete a resource.
+    async def delete(self, collection, id):
+        resource = await self.find(collection, id)
+        if resource is None:
+            raise HttpError(404, collection.name + "/" + id + " not found")
+
+        def write():
+            delete_resources(collection.name, [str(resource.uuid)])
+            collection.del_resource(resource.uuid)
+            collection.save_indexes()
+
+        await asyncio.get_running_loop().run_in_executor(self.writer, write)
+        return 204, "", ()
+
+    #
+    # Route a request.
+    # Return the route name used for the metrics and a coroutine for the (status, body, headers) of the response.
+    #
+    def route(self, method, target, body):
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.split("/") if part != ""]
+        if parts == ["_metrics"] and method == "GET":
+            return "GET metrics", self.get_metrics()
+        if len(parts) == 1 and method == "GET":
+            return "GET search", self.search(self.get_collection(parts[0]), url.query)
+        if len(parts) == 1 and method == "POST":
+            return "POST create", self.create(self.get_collection(parts[0]), body)
+        if len(parts) == 2 and method == "GET":
+            return "GET read", self.read(self.get_collection(parts[0]), parts[1])
+        if len(parts) == 2 and method == "PUT":
+            return "PUT update", self.update(self.get_collection(parts[0]), parts[1], body)
+        if len(parts) == 2 and method == "DELETE":
+            return "DELETE delete", self.delete(self.get_collection(parts[0]), parts[1])
+        if 1 <= len(parts) <= 2:
+            raise HttpError(405, method + " is not supported on " + url.path)
+        raise HttpError(404, "Unknown path " + url.path)
+
+    async def get_metrics(self):
+        return 200, json.dumps(self.metrics.to_json()), ()
+
+    # Handle a request, return the (status, body, headers) of the response.
+    async def handle(self, method, target, body):
+        start = time.perf_counter()
+        route = "error"
+        try:
+            route, response = self.route(method, target, body)
+            status, data, headers = await response
+        except HttpError as error:
+            status, data, headers = error.status, error.to_json(), ()
+        except Exception as error:
+            status, data, headers = 500, HttpError(500, str(error)).to_json(), ()
+        self.metrics.add(route, (time.perf_counter() - start) * 10 ** 3)
+        return status, data, headers
+
+    # Read the requests of a connection and write their responses.
+    async def handle_connection(self, reader, writer):
+        self.metrics.connections += 1
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode("latin-1").split()
+                except ValueError:
+                    await self.respond(writer, 400, HttpError(400, "Invalid request line").to_json(), (), False)
+                    break
+
+                headers = dict()
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                try:
+                    length = int(headers.get("content-length", "0"))
+                except ValueError:
+                    length = -1
+                if length < 0 or length > MAX_BODY:
+                    await self.respond(writer, 413, HttpError(413, "Invalid request body").to_json(), (), False)
+                    break
+                body = await reader.readexactly(length) if length > 0 else b""
+
+                status, data, extra = await self.handle(method.upper(), target, body)
+                await self.respond(writer, status, data, extra, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.metrics.connections -= 1
+            writer.close()
+
+    # Write a response.
+    async def respond(self, writer, status, data, headers, keep_alive):
+        body = data.encode("utf-8")
+        head = "HTTP/1.1 " + str(status) + " " + REASONS[status] + "\r\n" + \
+            "Content-Type: " + CONTENT_TYPE + "\r\n" + \
+            "Content-Length: " + str(len(body)) + "\r\n" + \
+            "Connection: " + ("keep-alive" if keep_alive else "close") + "\r\n" + \
+            "".join(name + ": " + value + "\r\n" for name, value in headers) + "\r\n"
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def start(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        print("Serving FHIR on http://" + host + ":" + str(port))
+        async with server:
+            await server.serve_forever()
+
+
+#
+# Serve the FHIR REST API of a schema until interrupted, then print the request metrics.
+#
+def serve(schema, host, port, workers=None):
+    server = FhirServer(schema, workers)
+    try:
+        asyncio.run(server.start(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown()
+        server.writer.shutdown()
+        print(server.metrics)
@@ -0,0 +1,756 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+
+from record import encode_record, KeyTable
+from schema import Schema
+
+# Record operations.
+PUT = 1
+BLOCK = 2
+LINK = 3
+DELETE = 4
+
+# A record is a header followed by the resource id and the resource data.
+# Header: operation, id length, data length.
+# The data is a binary record of the resource, or its FHIR (json) text when it cannot be encoded, see record.py.
+# A BLOCK record holds PUT records compressed together with zlib, see SegmentStore.compress().
+# Its id is the number of the preset dictionary the block was compressed with, 0 for none.
+# A LINK record gives a resource the data of an earlier record with the same content,
+# its data is the content digest, see get_digest().
+# A DELETE record removes a resource, its data is empty.
+HEADER = struct.Struct("<BHI")
+
+# Start a new segment when the active segment reaches this size.
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Save the offset index when this many bytes have been appended since it was saved.
+OFFSETS_SAVE_SIZE = 16 * 1024 * 1024
+
+# The store directory in a collection directory.
+# The leading '.' hides it from the file per resource layout.
+STORE_DIRECTORY = ".store"
+OFFSETS_FILE = "offsets"
+COMPRESSION_FILE = "compression"
+KEYS_FILE = "keys"
+
+# A compressed store puts about this many bytes of records in a block.
+# A read decompresses the whole block, so small blocks keep single reads fast.
+BLOCK_SIZE = 16 * 1024
+
+# The default zlib compression level.
+COMPRESSION_LEVEL = 6
+
+# zlib uses at most the last 32K of a preset dictionary.
+DICTIONARY_SIZE = 32 * 1024
+
+# Number of records sampled to build a preset dictionary.
+DICTIONARY_SAMPLE = 256
+
+# Number of decompressed blocks a store keeps for reads.
+BLOCK_CACHE = 16
+
+# Number of blocks decompressed to measure the decode rate of a store.
+DECODE_SAMPLE = 64
+
+
+# Add a record to a block.
+# Return the offset and length of the record data in the block.
+def add_record(block, operation, id, data):
+    id = id.encode()
+    block += HEADER.pack(operation, len(id), len(data))
+    block += id
+    block += data
+    return len(block) - len(data), len(data)
+
+
+# Get the content digest of record data.
+def get_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+#
+# Split a block into whole records, a partly written record at the end is left out.
+# Return a list of (operation, id, record offset, data offset, data length) and the length of the whole records.
+#
+def split_records(block):
+    records = list()
+    position = 0
+    while position + HEADER.size <= len(block):
+        operation, id_length, data_length = HEADER.unpack_from(block, position)
+        end = position + HEADER.size + id_length + data_length
+        if end > len(block):
+            # A partly written record.
+            break
+        id = bytes(block[position + HEADER.size:position + HEADER.size + id_length]).decode()
+        records.append((operation, id, position, end - data_length, data_length))
+        position = end
+    return records, position
+
+
+# Split a list of (id, data) records into groups of about BLOCK_SIZE bytes.
+def get_groups(records):
+    group = list()
+    size = 0
+    for record in records:
+        group.append(record)
+        size += len(record[1])
+        if size >= BLOCK_SIZE:
+            yield group
+            group = list()
+            size = 0
+    if group:
+        yield group
+
+
+#
+# Build a zlib preset dictionary from the records of a store.
+# Records are sampled evenly through the store and identical records are kept once.
+# The most common records go at the end of the dictionary, where matches are cheapest.
+#
+def build_dictionary(records):
+    step = max(1, len(records) // DICTIONARY_SAMPLE)
+    counts = Counter(bytes(records[i]) for i in range(0, len(records), step))
+    dictionary = b""
+    for record, count in counts.most_common():
+        if len(dictionary) + len(record) <= DICTIONARY_SIZE:
+            dictionary = record + dictionary
+    return dictionary
+
+
+#
+# A SegmentStore keeps the resources of a collection in append-only segment files
+# of length-prefixed records. The latest record for an id supersedes earlier ones.
+# A store has:
+#   - The store directory
+#   - An offset index of resource id to (segment, data offset, data length),
+#     or (segment, block offset, block length, data offset, data length) for a record in a compressed block
+#   - The size of each segment covered by the offset index
+#   - The memory mapped segments, when the store is mapped
+#   - The compression level and dictionary number, None when records are not compressed
+#   - The preset dictionaries by number and the recently decompressed blocks
+#   - The decompressed size of each BLOCK record by (segment, offset), for the compression ratio
+#   - The location of the data of each content digest, the digest of each resource id and the
+#     number of resources with each digest, identical resources share one copy of their data
+#   - The attribute names of the binary records, see record.KeyTable
+#
+class SegmentStore:
+
+    def __init__(self, name):
+        self.name = name
+        self.path = os.path.join(Schema.ROOT, name, STORE_DIRECTORY)
+        self.offsets = dict()
+        self.sizes = dict()
+        self.unsaved = 0
+        self.mapped = False
+        self.mappings = dict()
+        self.compression = None
+        self.dictionaries = dict()
+        self.blocks = OrderedDict()
+        self.plain = dict()
+        self.lock = threading.Lock()
+        self.digests = dict()
+        self.links = dict()
+        self.references = dict()
+        self.keys = KeyTable()
+        self.saved_keys = 0
+
+    # Resources that share a body save the size of the body, that is shown as the deduplicated bytes.
+    # The compression ratio is the decompressed size of the BLOCK records in use to their compressed size.
+    def __str__(self):
+        size = sum(location[-1] for location in set(self.offsets.values()))
+        shared = sum(location[-1] for location in self.offsets.values()) - size
+        text = "packed, " + str(len(self.sizes)) + " segments, " + str(sum(self.sizes.values())) + " bytes, " + \
+            str(len(self.references)) + " bodies, " + str(shared) + " bytes deduplicated"
+        if self.compression is not None:
+            blocks = set(location[:3] for location in self.offsets.values() if len(location) == 5)
+            compressed = sum(length for segment, offset, length in blocks)
+            plain = sum(self.plain[segment, offset] for segment, offset, length in blocks)
+            text += ", zlib level " + str(self.compression["level"]) + ", dictionary " + \
+                str(len(self.get_dictionary(self.compression["dictionary"]))) + " bytes, ratio " + \
+                str(round(plain / max(1, compressed), 2))
+        return text
+
+    # Get the file name of a segment.
+    def get_segment_file(self, segment):
+        return os.path.join(self.path, "segment-%06d.dat" % segment)
+
+    # Get the segment numbers in the store directory.
+    def get_segments(self):
+        segments = list()
+        for entry in os.listdir(self.path):
+            if entry.startswith("segment-") and entry.endswith(".dat"):
+                segments.append(int(entry[8:-4]))
+        return sorted(segments)
+
+    # Get the file name of a preset dictionary.
+    def get_dictionary_file(self, number):
+        return os.path.join(self.path, "dictionary-%06d" % number)
+
+    # Get the preset dictionary numbers in the store directory.
+    def get_dictionary_numbers(self):
+        return [int(entry[11:]) for entry in os.listdir(self.path) if entry.startswith("dictionary-")]
+
+    # Get a preset dictionary by number, 0 for no dictionary.
+    def get_dictionary(self, number):
+        if number == 0:
+            return b""
+        dictionary = self.dictionaries.get(number)
+        if dictionary is None:
+            with open(self.get_dictionary_file(number), "rb") as file:
+                dictionary = file.read()
+            self.dictionaries[number] = dictionary
+        return dictionary
+
+    # Create the store directory.
+    def create(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    #
+    # Open the store.
+    # Read the offset index and scan any records appended after it was saved.
+    #
+    def open(self):
+        self.offsets.clear()
+        self.sizes.clear()
+        self.digests.clear()
+        self.links.clear()
+        self.references.clear()
+        self.plain.clear()
+        try:
+            with open(os.path.join(self.path, COMPRESSION_FILE), "r") as file:
+                self.compression = json.load(file)
+        except (FileNotFoundError, ValueError):
+            self.compression = None
+        self.load_keys()
+        try:
+            with open(os.path.join(self.path, OFFSETS_FILE), "r") as file:
+                saved = json.load(file)
+            plain = {(segment, offset): size for segment, offset, size in saved["blocks"]}
+            self.offsets = {id: tuple(offset) for id, offset in saved["offsets"].items()}
+            self.sizes = {int(segment): size for segment, size in saved["sizes"].items()}
+            digests = {tuple(entry[1:]): entry[0] for entry in saved["digests"]}
+            for id, location in self.offsets.items():
+                if location in digests:
+                    self.add_reference(id, digests[location], location)
+            self.plain = plain
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        for segment in self.get_segments():
+            size = os.path.getsize(self.get_segment_file(segment))
+            start = self.sizes.get(segment, 0)
+            if size > start:
+                with open(self.get_segment_file(segment), "rb") as file:
+                    file.seek(start)
+                    self.scan(segment, start, file.read())
+                self.unsaved += size - start
+
+    # Add the records in a block read from a segment at position start to the offset index.
+    def scan(self, segment, start, block):
+        records, size = split_records(block)
+        for operation, id, position, offset, length in records:
+            if operation == PUT:
+                self.add_reference(id, get_digest(block[offset:offset + length]), (segment, start + offset, length))
+            elif operation == LINK:
+                digest = bytes(block[offset:offset + length]).decode()
+                if digest in self.digests:
+                    self.add_reference(id, digest, self.digests[digest])
+            elif operation == DELETE:
+                self.remove_reference(id)
+            elif operation == BLOCK:
+                plain = self.decompress(int(id), block[offset:offset + length])
+                self.plain[segment, start + position] = len(plain)
+                for _, record_id, _, record_offset, record_length in split_records(plain)[0]:
+                    self.add_reference(record_id, get_digest(plain[record_offset:record_offset + record_length]),
+                                       (segment, start + position, offset + length - position,
+                                        record_offset, record_length))
+        self.sizes[segment] = start + size
+
+    # Set the location and digest of a resource's data, and count the resources with each digest.
+    def add_reference(self, id, digest, location):
+        old = self.links.get(id)
+        if old is not None:
+            self.drop_reference(old)
+        self.links[id] = digest
+        self.references[digest] = self.references.get(digest, 0) + 1
+        self.digests.setdefault(digest, location)
+        self.offsets[id] = location
+
+    # Remove the location and digest of a resource's data, the data stays until the store is compacted.
+    def remove_reference(self, id):
+        old = self.links.pop(id, None)
+        if old is not None:
+            self.drop_reference(old)
+        self.offsets.pop(id, None)
+
+    # Count one resource fewer with a digest.
+    def drop_reference(self, digest):
+        self.references[digest] -= 1
+        if self.references[digest] == 0:
+            del self.references[digest]
+
+    # Decompress the data of a block record with its preset dictionary.
+    def decompress(self, number, data):
+        dictionary = self.get_dictionary(number)
+        decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
+
+    # Decompress a whole block record.
+    def decompress_block(self, block):
+        operation, id_length, data_length = HEADER.unpack_from(block)
+        return self.decompress(int(bytes(block[HEADER.size:HEADER.size + id_length])),
+                               block[HEADER.size + id_length:])
+
+    #
+    # Read and decompress the block record at a location in a segment.
+    # Recently read blocks are kept, so reading the records of a block in order decompresses it once.
+    #
+    def read_block(self, segment, offset, length):
+        key = (segment, offset)
+        with self.lock:
+            plain = self.blocks.get(key)
+            if plain is not None:
+                self.blocks.move_to_end(key)
+                return plain
+        plain = self.decompress_block(self.read_at(segment, offset, length))
+        with self.lock:
+            self.blocks[key] = plain
+            if len(self.blocks) > BLOCK_CACHE:
+                self.blocks.popitem(last=False)
+        return plain
+
+    # Get the [digest, location ...] of the data of every resource, resources with the same content share one.
+    def get_digests(self):
+        locations = {self.offsets[id]: digest for id, digest in self.links.items()}
+        return [[digest] + list(location) for location, digest in locations.items()]
+
+    # Get the [segment, offset, decompressed size] of the BLOCK records in use.
+    def get_blocks(self):
+        blocks = set(location[:2] for location in self.offsets.values() if len(location) == 5)
+        return [[segment, offset, self.plain[segment, offset]] for segment, offset in blocks]
+
+    # Load the attribute names of the binary records.
+    def load_keys(self):
+        try:
+            with open(os.path.join(self.path, KEYS_FILE), "r") as file:
+                self.keys = KeyTable(json.load(file))
+        except FileNotFoundError:
+            self.keys = KeyTable()
+        self.saved_keys = len(self.keys)
+
+    #
+    # Save the attribute names of the binary records when names have been added.
+    # The names are saved before the records that use them are written.
+    #
+    def save_keys(self):
+        if len(self.keys) == self.saved_keys:
+            return
+        path = os.path.join(self.path, KEYS_FILE)
+        with open(path + ".tmp", "w") as file:
+            file.write(json.dumps(self.keys.names))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+        self.saved_keys = len(self.keys)
+
+    # Save the offset index.
+    def save_offsets(self):
+        path = os.path.join(self.path, OFFSETS_FILE)
+        with open(path + ".tmp", "w") as file:
+            file.write(json.dumps({"offsets": self.offsets, "sizes": self.sizes, "digests": self.get_digests(),
+                                   "blocks": self.get_blocks()}))
+        os.replace(path + ".tmp", path)
+        self.unsaved = 0
+
+    #
+    # Read every resource in storage order.
+    # Each segment is read with one sequential read.
+    # Return a list of (id, data bytes).
+    #
+    def read_all(self):
+        by_segment = dict()
+        for id, location in self.offsets.items():
+            by_segment.setdefault(location[0], list()).append((location[1:], id))
+
+        result = list()
+        for segment in sorted(by_segment):
+            with open(self.get_segment_file(segment), "rb") as file:
+                block = file.read()
+            block_offset = plain = None
+            previous = data = None
+            for location, id in sorted(by_segment[segment]):
+                if location == previous:
+                    # Resources with the same content share their data.
+                    result.append((id, data))
+                    continue
+                previous = location
+                offset, length = location[:2]
+                if len(location) == 2:
+                    data = block[offset:offset + length]
+                else:
+                    if offset != block_offset:
+                        block_offset = offset
+                        plain = self.decompress_block(block[offset:offset + length])
+                    start, size = location[2:]
+                    data = plain[start:start + size]
+                result.append((id, data))
+        return result
+
+    # Read the data of a resource.
+    def read(self, id):
+        return self.read_at(*self.offsets[id])
+
+    # Read the data at a location in a segment.
+    # A record in a compressed block has a start and size in the decompressed block.
+    def read_at(self, segment, offset, length, start=None, size=None):
+        if start is not None:
+            return self.read_block(segment, offset, length)[start:start + size]
+        if self.mapped:
+            return self.read_mapped(segment, offset, length)
+        with open(self.get_segment_file(segment), "rb") as file:
+            file.seek(offset)
+            return file.read(length)
+
+    # Get the location of every resource in storage order.
+    # Return a list of (id, location), see read_at().
+    def get_locations(self):
+        return sorted(self.offsets.items(), key=lambda entry: entry[1])
+
+    #
+    # Read the data of a resource from a memory mapped segment.
+    # The segment is mapped on first use and re-mapped when it has grown past the mapping.
+    # The mappings are read only and shared through the page cache with other processes.
+    # A mapping is replaced under the lock and not closed, a reader may still be slicing it,
+    # it is closed when the last reference to it is dropped.
+    #
+    def read_mapped(self, segment, offset, length):
+        with self.lock:
+            mapping = self.mappings.get(segment)
+            if mapping is None or offset + length > len(mapping):
+                with open(self.get_segment_file(segment), "rb") as file:
+                    mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.mappings[segment] = mapping
+        return mapping[offset:offset + length]
+
+    # Drop the memory mapped segments, each is closed when no reader holds it.
+    def unmap(self):
+        with self.lock:
+            self.mappings.clear()
+
+    #
+    # Append a list of (id, data bytes) records with one write.
+    # The active segment is the last segment, a new one is started when it is full.
+    # Data that is already in the store is linked to, not written again.
+    #
+    def append(self, records):
+        segment, start = self.get_end()
+        block = bytearray()
+        references = self.add_unique_records(block, segment, start, records)
+
+        self.save_keys()
+        with open(self.get_segment_file(segment), "ab") as file:
+            file.write(block)
+            file.flush()
+            os.fsync(file.fileno())
+
+        for id, digest, location in references:
+            self.add_reference(id, digest, location)
+        self.sizes[segment] = start + len(block)
+        self.unsaved += len(block)
+        if self.unsaved >= OFFSETS_SAVE_SIZE:
+            self.save_offsets()
+
+    #
+    # Delete a list of resource ids with one write of a DELETE record for each.
+    # The offsets of deleted resources are dropped, and compact drops their data.
+    #
+    def delete(self, ids):
+        segment, start = self.get_end()
+        block = bytearray()
+        for id in ids:
+            add_record(block, DELETE, id, b"")
+
+        with open(self.get_segment_file(segment), "ab") as file:
+            file.write(block)
+            file.flush()
+            os.fsync(file.fileno())
+
+        for id in ids:
+            self.remove_reference(id)
+        self.sizes[segment] = start + len(block)
+        self.unsaved += len(block)
+        if self.unsaved >= OFFSETS_SAVE_SIZE:
+            self.save_offsets()
+
+    # Get the active segment, the last one or a new one when it is full, and the position at its end.
+    def get_end(self):
+        segment = max(self.sizes) if self.sizes else 1
+        start = self.sizes.get(segment, 0)
+        if start >= SEGMENT_SIZE:
+            return segment + 1, 0
+        return segment, start
+
+    #
+    # Add a list of (id, data) records to a block that is written to a segment at position start.
+    # Data that is in the store, or earlier in the list, is added as a LINK record to the data.
+    # Return the (id, digest, location) of each record, see add_reference().
+    #
+    def add_unique_records(self, block, segment, start, records):
+        unique = list()
+        links = list()
+        new = dict()
+        for id, data in records:
+            digest = get_digest(data)
+            if digest in self.digests or digest in new:
+                links.append((id, digest))
+            else:
+                new[digest] = id
+                unique.append((id, data))
+
+        locations = dict()
+        plain = dict()
+        for location in self.add_records(block, unique, plain):
+            locations[location[0]] = (segment, start + location[1]) + location[2:]
+        for offset, size in plain.items():
+            self.plain[segment, start + offset] = size
+        for id, digest in links:
+            add_record(block, LINK, id, digest.encode())
+
+        references = [(id, digest, locations[id]) for digest, id in new.items()]
+        references += [(id, digest, self.digests[digest] if digest in self.digests else locations[new[digest]])
+                       for id, digest in links]
+        return references
+
+    #
+    # Add a list of (id, data) records to a block, in compressed blocks when the store is compressed.
+    # Return the (id, offset, length) of each record in the block, or
+    # (id, block offset, block length, data offset, data length) for a record in a compressed block.
+    # The decompressed size of each BLOCK record is set in plain by its offset in the block.
+    #
+    def add_records(self, block, records, plain):
+        if self.compression is None:
+            return [(id,) + add_record(block, PUT, id, data) for id, data in records]
+
+        number = self.compression["dictionary"]
+        dictionary = self.get_dictionary(number)
+        locations = list()
+        for group in get_groups(records):
+            contents = bytearray()
+            entries = [(id,) + add_record(contents, PUT, id, data) for id, data in group]
+            if dictionary:
+                compressor = zlib.compressobj(self.compression["level"], zdict=dictionary)
+            else:
+                compressor = zlib.compressobj(self.compression["level"])
+            offset = len(block)
+            plain[offset] = len(contents)
+            add_record(block, BLOCK, str(number), compressor.compress(bytes(contents)) + compressor.flush())
+            locations += [(id, offset, len(block) - offset, start, size) for id, start, size in entries]
+        return locations
+
+    #
+    # Compact the store.
+    # The latest record of each resource is written to new segments and the old segments are removed.
+    # Data no resource refers to is dropped and identical data is written once.
+    # records is the (id, data) of every resource when they have already been read.
+    #
+    def compact(self, records=None):
+        old_segments = self.get_segments()
+        if records is None:
+            records = self.read_all()
+        self.offsets.clear()
+        self.sizes.clear()
+        self.digests.clear()
+        self.links.clear()
+        self.references.clear()
+        self.plain.clear()
+
+        segment = old_segments[-1] + 1 if old_segments else 1
+        block = bytearray()
+        records = list(records)
+        for group in get_groups(records):
+            for id, digest, location in self.add_unique_records(block, segment, 0, group):
+                self.add_reference(id, digest, location)
+            if len(block) >= SEGMENT_SIZE:
+                self.write_segment(segment, block)
+                segment += 1
+                block = bytearray()
+        if block or not self.sizes:
+            self.write_segment(segment, block)
+
+        self.save_offsets()
+        self.unmap()
+        with self.lock:
+            self.blocks.clear()
+        for old in old_segments:
+            os.remove(self.get_segment_file(old))
+
+        # Dictionaries of the old segments are no longer used.
+        current = self.compression["dictionary"] if self.compression is not None else 0
+        for number in self.get_dictionary_numbers():
+            if number != current:
+                os.remove(self.get_dictionary_file(number))
+                self.dictionaries.pop(number, None)
+
+    #
+    # Compress the records of the store in blocks with zlib at a level (1 to 9), or store them
+    # uncompressed when level is None. The blocks are compressed with a preset dictionary built from
+    # a sample of the records, so small blocks and single inserts still compress well.
+    # Every record is written again by compact().
+    #
+    def compress(self, level):
+        records = self.read_all()
+        if level is None:
+            self.compression = None
+        else:
+            number = max(self.get_dictionary_numbers() + [0]) + 1
+            dictionary = build_dictionary([data for id, data in records])
+            with open(self.get_dictionary_file(number), "wb") as file:
+                file.write(dictionary)
+                file.flush()
+                os.fsync(file.fileno())
+            self.dictionaries[number] = dictionary
+            self.compression = {"level": level, "dictionary": number}
+
+        path = os.path.join(self.path, COMPRESSION_FILE)
+        with open(path + ".tmp", "w") as file:
+            file.write(json.dumps(self.compression))
+        os.replace(path + ".tmp", path)
+        self.compact(records)
+
+    #
+    # Measure the rate blocks are decompressed at, in MB of records a second, from a sample of blocks.
+    # Return None if the store has no compressed blocks.
+    #
+    def get_decode_rate(self):
+        blocks = sorted(set(location[:3] for location in self.offsets.values() if len(location) == 5))
+        blocks = [self.read_at(*block) for block in blocks[::max(1, len(blocks) // DECODE_SAMPLE)]]
+        if not blocks:
+            return None
+        start = time.perf_counter()
+        size = sum(len(self.decompress_block(block)) for block in blocks)
+        return size / max(time.perf_counter() - start, 10 ** -9) / 10 ** 6
+
+    # Write a new segment.
+    def write_segment(self, segment, block):
+        with open(self.get_segment_file(segment), "wb") as file:
+            file.write(block)
+            file.flush()
+            os.fsync(file.fileno())
+        self.sizes[segment] = len(block)
+
+
+# Number of resources written at a time by save_resources().
+BATCH_SIZE = 1000
+
+# Open segment stores by collection name, None for the file per resource layout.
+stores = dict()
+
+
+#
+# Get the segment store of a collection.
+# Return None if the collection uses the file per resource layout.
+#
+def get_store(name):
+    if name not in stores:
+        store = None
+        if os.path.isdir(os.path.join(Schema.ROOT, name, STORE_DIRECTORY)):
+            store = SegmentStore(name)
+            store.open()
+        stores[name] = store
+    return stores[name]
+
+
+#
+# Get the (id, binary record) of each resource in a list, see record.py.
+# keys is the KeyTable of the store the records are written to.
+# Copies made by the load command share their data, which is then encoded once.
+#
+def get_records(resources, keys):
+    records = list()
+    data = record = None
+    for resource in resources:
+        text = resource.data
+        if text is not data:
+            data = text
+            record = encode_record(data, keys)
+        records.append((str(resource.uuid), record))
+    return records
+
+
+#
+# Save a list of resources to the storage of a collection.
+# A packed collection appends each batch of resources with one write and one fsync.
+#
+def save_resources(name, resources):
+    store = get_store(name)
+    for start in range(0, len(resources), BATCH_SIZE):
+        batch = resources[start:start + BATCH_SIZE]
+        if store is not None:
+            store.append(get_records(batch, store.keys))
+        else:
+            path = os.path.join(Schema.ROOT, name)
+            for resource in batch:
+                with open(os.path.join(path, str(resource.uuid)), "w") as file:
+                    file.write(resource.data)
+        for resource in batch:
+            resource.state = Schema.SAVED
+
+
+#
+# Delete a list of resource ids from the storage of a collection.
+# A packed collection writes a DELETE record for each id, see SegmentStore.delete().
+#
+def delete_resources(name, ids):
+    store = get_store(name)
+    if store is not None:
+        store.delete([id for id in ids if id in store.offsets])
+        return
+    path = os.path.join(Schema.ROOT, name)
+    for id in ids:
+        try:
+            os.remove(os.path.join(path, id))
+        except FileNotFoundError:
+            pass
+
+
+#
+# Migrate a collection from the file per resource layout to a segment store.
+# The resources are read before the store is used, since resources that are not in memory
+# are read from their files until the store holds them.
+# Return the store, or None if the store could not be written.
+#
+def migrate(collection):
+    store = get_store(collection.name)
+    created = store is None
+    if created:
+        store = SegmentStore(collection.name)
+    records = get_records(collection.resources, store.keys)
+    try:
+        if created:
+            store.create()
+        store.append(records)
+        store.save_offsets()
+    except OSError:
+        if created:
+            shutil.rmtree(store.path, ignore_errors=True)
+        return None
+    stores[collection.name] = store
+
+    # Remove the resource files now they are in the store.
+    path = os.path.join(Schema.ROOT, collection.name)
+    for entry in os.listdir(path):
+        if entry[0] != '.':
+            os.remove(os.path.join(path, entry))
+    return store
@@ -0,0 +1,88 @@
+"""
+FHIR Server Proof of Concept
+Author: Tim Hastings, 2023
+"""
+from storage import get_store, migrate, COMPRESSION_LEVEL
+
+
+#
+# Migrate collection command.
+# Move a collection from one file per resource to packed segment storage.
+# migrate <collection>
+#
+def migrate_collection(schema, command_line):
+    if len(command_line) < 2:
+        print("Invalid migrate command - collection name missing")
+        return
+
+    collection = schema.get_collection(command_line[1])
+    if collection is None:
+        print("Invalid Collection")
+        return
+
+    store = migrate(collection)
+    if store is None:
+        print("Cannot migrate collection")
+        return
+    print(collection.name, store)
+
+
+#
+# Compact collection command.
+# Drop superseded versions of resources from packed segment storage.
+# compact <collection>
+#
+def compact_collection(schema, command_line):
+    if len(command_line) < 2:
+        print("Invalid compact command - collection name missing")
+        return
+
+    collection = schema.get_collection(command_line[1])
+    if collection is None:
+        print("Invalid Collection")
+        return
+
+    store = get_store(collection.name)
+    if store is None:
+        print("Collection is not packed - use migrate")
+        return
+
+    store.compact()
+    collection.relocate(store)
+    print(collection.name, store)
+
+
+#
+# Compress collection command.
+# Compress the packed segment storage of a collection in blocks with zlib and a preset dictionary
+# built from a sample of the collection, or store it uncompressed again with off.
+# compress <collection> [<level>|off]
+#
+def compress_collection(schema, command_line):
+    if len(command_line) < 2:
+        print("Invalid compress command - collection name missing")
+        return
+
+    collection = schema.get_collection(command_line[1])
+    if collection is None:
+        print("Invalid Collection")
+        return
+
+    store = get_store(collection.name)
+    if store is None:
+        print("Collection is not packed - use migrate")
+        return
+
+    level = COMPRESSION_LEVEL
+    if len(command_line) > 2:
+        if command_line[2] == "off":
+            level = None
+        elif command_line[2].isdigit() and 1 <= int(command_line[2]) <= 9:
+            level = int(command_line[2])
+        else:
+            print("Invalid compress command - level must be 1 to 9 or off")
+            return
+
+    store.compress(level)
+    collection.relocate(store)
+    print(collection.name, store)